@@ -3,21 +3,30 @@
 # @Time    : 2020-07-30 12:23
 # @Author  : NingAnMe <ninganme@qq.com>
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 import pandas as pd
 from scipy import stats
 
 from lib.aod import AodFy3d
-from lib.aeronet import Aeronet
+from lib.aeronet import AeronetCatalog, AeronetSiteIndex, AeronetStore
+from lib.matchup_store import MatchupStore
 from lib.plot import plot_regression
-from lib.verification import Verification
+from lib.product import fy3d_mersi_aod_datetime
+from lib.regression_stats import RegressionStats, get_sums
+from lib.verification import Verification, get_lon_lat_box
 
-aeronet_map_file = r'site_info.csv'
+aeronet_catalog_file = r'site_catalog.csv'
 fy3d_aod_dir = r'/home/kts_project_v1/qiuh/mod_aod/fy3d_aod/Granule'  # gongsi
 aeronet_aod_dir = r'/DATA/PROJECT/SourceData/Aeronet/AOD/AOD20/ALL_POINTS'  # gongsi
 fy3d_aeronet_dir = r'/home/kts_project_v1/qiuh/mod_aod/fy3d_aeronet'
 fy3d_aeronet_image_dir = r'/home/kts_project_v1/qiuh/mod_aod/fy3d_aeronet_image'
+aeronet_cache_dir = r'/home/kts_project_v1/qiuh/mod_aod/aeronet_cache'
+matchup_store_dir = r'/home/kts_project_v1/qiuh/mod_aod/matchup_store'
+matchup_pair = 'FY3D_MERSI+AERONET'
+regression_stats_file = r'/home/kts_project_v1/qiuh/mod_aod/regression_stats.idx'
 
 
 # fy3d_aod_dir = r'/nas02/cma/AEROSOL_1.0/SupportData/FY3D_MERSI/Granule'
@@ -33,39 +42,58 @@ def print_info(data):
     print(np.nanmin(data), np.nanmax(data), np.nanmean(data))
 
 
-def verification(fy3d_aod_file, aeronet_map, aeronet_file_dir):
+def verification(fy3d_aod_file, aeronet_map, aeronet_store, window=None, matchup_store=None):
+    """
+    :param aeronet_map: lib.aeronet.AeronetSiteIndex
+    :param aeronet_store: lib.aeronet.AeronetStore
+    :param window: None 时只使用最近的 FY3D 像元，否则额外输出最近像元周围 window x window 窗口的统计值
+    :param matchup_store: lib.matchup_store.MatchupStore，None 时每个 granule 输出一个 csv 文件
+    :return: 匹配结果 DataFrame，没有匹配结果时返回 None
+    """
     print(f"<<< {fy3d_aod_file}")
-    fy3d_aod_name = os.path.splitext(os.path.basename(fy3d_aod_file))[0]
-    out_file = os.path.join(fy3d_aeronet_dir, fy3d_aod_name + '.csv')
-    if os.path.exists(out_file):
-        print('输出文件已经存在：{}'.format(out_file))
+    if is_done(fy3d_aod_file, matchup_store):
+        print('输出已经存在：{}'.format(fy3d_aod_file))
         return
     # 获取数据1
-    aod1 = AodFy3d(in_file=fy3d_aod_file, geo_file=fy3d_aod_file)
-    c_aod1 = aod1.get_aod()
+    # 读完后关闭文件，同时释放这个 granule 的解码缓存
+    with AodFy3d(in_file=fy3d_aod_file, geo_file=fy3d_aod_file) as aod1:
+        c_aod1 = aod1.get_aod()
+        lons1, lats1 = aod1.get_lon_lat()
+        dt1 = aod1.dt
     valid_index = np.logical_and(c_aod1 > 0, c_aod1 < 10)
-    lons1, lats1 = aod1.get_lon_lat()
-    dt1 = aod1.dt
-    c_aod1 = c_aod1[valid_index]
-    lons1 = lons1[valid_index]
-    lats1 = lats1[valid_index]
-
-    # 获取数据2
-    aod2 = pd.read_csv(aeronet_map, index_col=False)
-    aod2.sort_values('dt_e', inplace=True, ascending=False)
-    lons2 = aod2['lon'].to_numpy()[:333]
-    lats2 = aod2['lat'].to_numpy()[:333]
-    name = aod2['name'].to_numpy()[:333]
+    if window is None:
+        c_aod1 = c_aod1[valid_index]
+        lons1 = lons1[valid_index]
+        lats1 = lats1[valid_index]
+    else:
+        # 保持 2 维，方便取窗口
+        c_aod1 = np.where(valid_index, c_aod1, np.nan)
+        lons1 = np.where(valid_index, lons1, np.nan)
+        lats1 = np.where(valid_index, lats1, np.nan)
+
+    # 剔除距离差距过大的点
+    pre_dist = 0.1
+    #   时间阈值
+    pre_dts = np.timedelta64(30, 'm')
+
+    # 获取数据2，只保留在 granule 时间有观测、并且在 granule 范围内的站点
+    box = get_lon_lat_box(lons1, lats1, margin=pre_dist)
+    if box is None:
+        print('没有有效的经纬度数据')
+        return
+    name, lons2, lats2 = aeronet_map.query(dt1, pre_dts=pre_dts, box=box)
+    if len(name) == 0:
+        print('没有可以匹配的站点')
+        return
 
     # 数据匹配
+    # 站点只有几百个，自动选择对站点建模（query 方向），不使用 KDtree 缓存
     verif = Verification(lons1, lats1, lons2, lats2)
     if not verif.get_kdtree():
         return
 
-    verif.get_dist_and_index_kdtree()
+    verif.get_dist_and_index_kdtree(pre_dist=pre_dist)
 
-    # 剔除距离差距过大的点
-    pre_dist = 0.1
     index_dist = verif.get_index_dist(pre_dist=pre_dist)
 
     # 匹配数据
@@ -80,40 +108,54 @@ def verification(fy3d_aod_file, aeronet_map, aeronet_file_dir):
             'name': verif.get_query_data(name)[index_dist],
             'dist': verif.dist[index_dist],
         }
+        if window is not None:
+            window_data = verif.get_kdtree_window_data(c_aod1, window=window)
+            for k, v in window_data.items():
+                result[f'aod_s1_{k}'] = v[index_dist]
     else:
         print('匹配的数据量 < 0')
         return
 
-    # 循环匹配到的站点，找到时间最接近的点
-    station_name = result['name']
-    #   时间阈值
-    pre_dts = pd.Timedelta('00:30:00')
-    dt2 = list()
-    aod2 = list()
-    for name in station_name:
-        for aeronet_filename in os.listdir(aeronet_file_dir):
-            name2 = '_'.join(os.path.splitext(aeronet_filename)[0].split('_')[2:])
-            if name == name2:
-                aeronet = Aeronet(os.path.join(aeronet_file_dir, aeronet_filename))
-                dts = aeronet.get_datetime()
-                dts = pd.to_datetime(dts, unit='s')
-                dts_delta = np.abs(dts - dt1)
-                index_dt = np.argmin(dts_delta)
-                if dts_delta[index_dt] < pre_dts:
-                    aod2.append(aeronet.get_aod550()[index_dt])
-                else:
-                    aod2.append(np.nan)
-                dt2.append(dts[index_dt])
+    # 匹配到的站点，找到时间最接近的点
+    aod2, dt2 = aeronet_store.match(result['name'], dt1, pre_dts=pre_dts)
     result['aod_s2'] = aod2
     result['dt_s2'] = dt2
     out_data_df = pd.DataFrame(result)
 
-    out_data_df.to_csv(out_file)
+    if matchup_store is None:
+        out_data_df.to_csv(get_out_file(fy3d_aod_file))
+    else:
+        matchup_store.write(out_data_df, get_granule_name(fy3d_aod_file), dt1)
     print(out_data_df)
+    return out_data_df
+
+
+def get_result_sums(result):
+    """
+    匹配结果的回归统计量，见 lib.regression_stats.get_sums
+    """
+    return get_sums(result['aod_s1'], result['aod_s2'], result['dt_s1'], result['name'])
+
+
+def get_granule_name(fy3d_aod_file):
+    return os.path.splitext(os.path.basename(fy3d_aod_file))[0]
+
+
+def get_out_file(fy3d_aod_file):
+    return os.path.join(fy3d_aeronet_dir, get_granule_name(fy3d_aod_file) + '.csv')
 
 
-def main_month():
+def is_done(fy3d_aod_file, matchup_store=None):
+    """
+    granule 的匹配结果是否已经存在
+    """
+    if matchup_store is None:
+        return os.path.exists(get_out_file(fy3d_aod_file))
+    dt = fy3d_mersi_aod_datetime(os.path.basename(fy3d_aod_file))
+    return matchup_store.exists(get_granule_name(fy3d_aod_file), dt)
 
+
+def get_fy3d_aod_files():
     aod_dir_list = os.listdir(fy3d_aod_dir)
     aod_dir_list.sort()
     for ymd in aod_dir_list:
@@ -126,10 +168,120 @@ def main_month():
                 continue
             if not os.path.splitext(fy3d_aod_file)[1] == '.HDF5':
                 continue
-            verification(fy3d_aod_file=fy3d_aod_file, aeronet_map=aeronet_map_file, aeronet_file_dir=aeronet_aod_dir)
+            yield fy3d_aod_file
+
+
+# 子进程内共享的只读数据，在 init_worker 中创建
+worker_aeronet_store = None
+worker_site_index = None
+worker_matchup_store = None
+
+
+def init_worker(aeronet_catalog, site_index, matchup_store=None):
+    global worker_aeronet_store, worker_site_index, worker_matchup_store
+    worker_site_index = site_index
+    worker_matchup_store = matchup_store
+    # AERONET 缓存是 memmap 文件，多个进程共享同一份页缓存
+    worker_aeronet_store = AeronetStore(aeronet_catalog, cache_dir=aeronet_cache_dir)
+
+
+def verification_chunk(fy3d_aod_files):
+    """
+    子进程中处理一组 granule
+    :return: ([(fy3d_aod_file, 耗时, 错误信息)], [(granule 名, 回归统计量)])
+    """
+    records = list()
+    sums = list()
+    for fy3d_aod_file in fy3d_aod_files:
+        t = time.time()
+        error = None
+        try:
+            result = verification(fy3d_aod_file=fy3d_aod_file, aeronet_map=worker_site_index,
+                                  aeronet_store=worker_aeronet_store, matchup_store=worker_matchup_store)
+            if result is not None:
+                sums.append((get_granule_name(fy3d_aod_file), get_result_sums(result)))
+        except Exception as why:
+            error = f'{type(why).__name__}: {why}'
+        records.append((fy3d_aod_file, time.time() - t, error))
+    return records, sums
+
+
+def print_summary(records, skip_count, cost):
+    print('========== 逐个 granule 耗时 ==========')
+    for fy3d_aod_file, granule_cost, error in sorted(records):
+        print(f'{granule_cost:8.2f}s  {"失败" if error else "成功"}  {fy3d_aod_file}')
+    failures = [r for r in records if r[2] is not None]
+    if failures:
+        print('========== 失败 ==========')
+        for fy3d_aod_file, _, error in failures:
+            print(f'{fy3d_aod_file}  {error}')
+    costs = np.array([r[1] for r in records])
+    print(f'granule 总数：{len(records) + skip_count} 处理：{len(records)} 跳过（输出已存在）：{skip_count} '
+          f'失败：{len(failures)} 总耗时：{cost:.1f}s')
+    if len(costs) > 0:
+        print(f'单个 granule 耗时 平均：{costs.mean():.2f}s 最大：{costs.max():.2f}s')
+
+
+def main_month(workers=None, chunksize=4, max_in_flight=None, use_store=True):
+    """
+    并行处理全部 granule
+    :param workers: 进程数，None 时使用全部 CPU
+    :param chunksize: 每个任务处理的 granule 数量
+    :param max_in_flight: 同时提交的最大任务数，限制内存占用，None 时为 2 * workers
+    :param use_store: 结果写入匹配结果列存储，否则每个 granule 输出一个 csv 文件
+    """
+    t = time.time()
+    if workers is None:
+        workers = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    # 站点目录在主进程建好，避免每个子进程都重新解析
+    aeronet_catalog = AeronetCatalog(aeronet_aod_dir, catalog_file=aeronet_catalog_file)
+    site_index = AeronetSiteIndex(aeronet_catalog.sites)
+    matchup_store = MatchupStore(matchup_store_dir, matchup_pair) if use_store else None
+    regression_stats = RegressionStats(regression_stats_file)
+
+    fy3d_aod_files = list()
+    skip_count = 0
+    for fy3d_aod_file in get_fy3d_aod_files():
+        if is_done(fy3d_aod_file, matchup_store):
+            skip_count += 1
+            continue
+        fy3d_aod_files.append(fy3d_aod_file)
+    chunks = [fy3d_aod_files[i:i + chunksize] for i in range(0, len(fy3d_aod_files), chunksize)]
+    print(f'granule 数量：{len(fy3d_aod_files)} 任务数量：{len(chunks)} 进程数：{workers}')
+
+    records = list()
+
+    def collect(future):
+        chunk_records, chunk_sums = future.result()
+        records.extend(chunk_records)
+        for granule, sums in chunk_sums:
+            regression_stats.merge(sums, granule)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(aeronet_catalog, site_index, matchup_store)) as executor:
+        in_flight = set()
+        for chunk in chunks:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            in_flight.add(executor.submit(verification_chunk, chunk))
+        for future in wait(in_flight).done:
+            collect(future)
+    regression_stats.save()
+
+    print_summary(records, skip_count, time.time() - t)
 
 
-def main_day():
+def main_day(use_store=True):
+    matchup_store = MatchupStore(matchup_store_dir, matchup_pair) if use_store else None
+    regression_stats = RegressionStats(regression_stats_file)
+    aeronet_catalog = AeronetCatalog(aeronet_aod_dir, catalog_file=aeronet_catalog_file)
+    aeronet_store = AeronetStore(aeronet_catalog, cache_dir=aeronet_cache_dir)
+    site_index = AeronetSiteIndex(aeronet_catalog.sites)
     ymd = '20190228'
     one_day_dir = os.path.join(fy3d_aod_dir, ymd)
     fy3d_aod_filenames = os.listdir(one_day_dir)
@@ -140,7 +292,11 @@ def main_day():
             continue
         if not os.path.splitext(fy3d_aod_file)[1] == '.HDF5':
             continue
-        verification(fy3d_aod_file=fy3d_aod_file, aeronet_map=aeronet_map_file, aeronet_file_dir=aeronet_aod_dir)
+        result = verification(fy3d_aod_file=fy3d_aod_file, aeronet_map=site_index, aeronet_store=aeronet_store,
+                              matchup_store=matchup_store)
+        if result is not None:
+            regression_stats.merge(get_result_sums(result), get_granule_name(fy3d_aod_file))
+    regression_stats.save()
 
 
 if __name__ == '__main__':
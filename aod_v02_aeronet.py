@@ -9,7 +9,7 @@ import pandas as pd
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 
-from lib.aeronet import Aeronet
+from lib.aeronet import Aeronet, AERONET_USECOLS
 
 data_path = '/DATA/PROJECT/SourceData/Aeronet/AOD/AOD20/ALL_POINTS'
 all_site_pkl = 'all_site.pkl'
@@ -24,17 +24,13 @@ def aeronet_site_info():
     site_info_filter = {}
     for f in files:
         file_ = os.path.join(data_path, f)
-        aeronet = Aeronet(file_)
+        aeronet = Aeronet(file_, usecols=AERONET_USECOLS)
         name, lon, lat = aeronet.get_site_name_lon_lat()
 
         dates = aeronet.get_datetime()
-        datetime_start = datetime_end = dates[0]
+        datetime_start = dates.min()
+        datetime_end = dates.max()
         datetime_max = datetime(2020, 5, 1)
-        for d in dates:
-            if d < datetime_start:
-                datetime_start = d
-            if d > datetime_end:
-                datetime_end = d
         print("{:20} {} {}".format(name, datetime_start, datetime_end))
 
         site_info[name] = (lon, lat, datetime_start, datetime_end)
@@ -4,30 +4,76 @@
 # @Author  : NingAnMe <ninganme@qq.com>
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from scipy import stats
 
+from lib.matchup_store import MatchupStore
 from lib.plot import plot_regression
+from lib.regression_stats import RegressionStats
 
 fy3d_aeronet_dir = r'/home/kts_project_v1/qiuh/mod_aod/fy3d_aeronet'
 fy3d_aeronet_image_dir = r'/home/kts_project_v1/qiuh/mod_aod/fy3d_aeronet_image'
+matchup_store_dir = r'/home/kts_project_v1/qiuh/mod_aod/matchup_store'
+matchup_pair = 'FY3D_MERSI+AERONET'
+regression_stats_file = r'/home/kts_project_v1/qiuh/mod_aod/regression_stats.idx'
 
+RESULT_COLUMNS = ('aod_s1', 'aod_s2')  # 回归只需要这两列
 
-def plot_aod_regression(ymd):
-    file_dir = os.path.join(fy3d_aeronet_dir, ymd)
-    result_files = os.listdir(file_dir)
-    result_data_all = None
-    for filename in result_files:
-        result_file = os.path.join(file_dir, filename)
-        result_data = pd.read_csv(result_file)
-        # print(result_data.head())
-        result_data = result_data.dropna(axis=0)
-        if result_data_all is None:
-            result_data_all = result_data
-        else:
-            result_data_all = pd.concat((result_data_all, result_data), axis=0)
+
+def load_store_data(dt_s, dt_e):
+    """
+    从匹配结果列存储读取 [dt_s, dt_e) 内的 aod_s1 和 aod_s2
+    """
+    matchup_store = MatchupStore(matchup_store_dir, matchup_pair)
+    result_data = matchup_store.read(columns=list(RESULT_COLUMNS), dt_s=dt_s, dt_e=dt_e)
+    result_data = filter_result_data(result_data)
+    if len(result_data) == 0:
+        return
+    return result_data
+
+
+def read_result_file(result_file, columns=RESULT_COLUMNS):
+    return pd.read_csv(result_file, usecols=list(columns), dtype={column: np.float32 for column in columns})
+
+
+def filter_result_data(result_data):
+    """
+    剔除 nan 和 aod_s1 <= 0 或 aod_s2 <= 0 的数据
+    """
+    x = result_data['aod_s1'].to_numpy()
+    y = result_data['aod_s2'].to_numpy()
+    return result_data[(x > 0) & (y > 0)]
+
+
+def load_result_files(result_files, columns=RESULT_COLUMNS, workers=8):
+    """
+    多线程读取多个匹配结果 csv 文件，只读取 columns 列（float32），最后只合并一次
+    :param result_files: csv 文件
+    :param columns: 读取的列
+    :param workers: 线程数
+    :return: DataFrame，没有数据时返回 None
+    """
+    result_files = list(result_files)
+    if not result_files:
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        result_datas = list(executor.map(lambda f: read_result_file(f, columns), result_files))
+    result_data = filter_result_data(pd.concat(result_datas, axis=0, ignore_index=True))
+    if len(result_data) == 0:
+        return
+    return result_data
+
+
+def plot_aod_regression(ymd, use_store=True):
+    if use_store:
+        dt_s = pd.Timestamp(ymd)
+        result_data_all = load_store_data(dt_s, dt_s + pd.Timedelta(days=1))
+    else:
+        file_dir = os.path.join(fy3d_aeronet_dir, ymd)
+        result_data_all = load_result_files(os.path.join(file_dir, filename) for filename in os.listdir(file_dir))
 
     print(result_data_all)
     if result_data_all is None or len(result_data_all) <= 10:
@@ -47,9 +93,6 @@ def plot_aod_regression(ymd):
     x = result_data_all['aod_s1'].to_numpy()
     y = result_data_all['aod_s2'].to_numpy()
 
-    index = np.logical_and.reduce((x > 0, y > 0))
-    x = x[index]
-    y = y[index]
     slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
     print(slope, intercept, r_value, r_value ** 2, p_value, std_err)
     plot_regression(
@@ -66,18 +109,16 @@ def plot_aod_regression(ymd):
     )
 
 
-def plot_aod_regression_month(ym):
-    filename_list = os.listdir(fy3d_aeronet_dir)
-    result_data_all = None
-    for filename in filename_list:
-        if ym in filename:
-            result_file = os.path.join(fy3d_aeronet_dir, filename)
-            result_data = pd.read_csv(result_file)
-            result_data = result_data.dropna(axis=0)
-            if result_data_all is None:
-                result_data_all = result_data
-            else:
-                result_data_all = pd.concat((result_data_all, result_data), axis=0)
+def plot_aod_regression_month(ym, use_store=True, mode='hist2d'):
+    """
+    :param mode: lib.plot.plot_regression 的 mode，一个月的匹配数据较多，默认画二维直方图
+    """
+    if use_store:
+        dt_s = pd.Timestamp(ym[:4] + '-' + ym[4:6])
+        result_data_all = load_store_data(dt_s, dt_s + pd.offsets.MonthBegin(1))
+    else:
+        result_data_all = load_result_files(os.path.join(fy3d_aeronet_dir, filename)
+                                            for filename in os.listdir(fy3d_aeronet_dir) if ym in filename)
 
     print(result_data_all)
     if result_data_all is None or len(result_data_all) <= 10:
@@ -97,9 +138,6 @@ def plot_aod_regression_month(ym):
     x = result_data_all['aod_s1'].to_numpy()
     y = result_data_all['aod_s2'].to_numpy()
 
-    index = np.logical_and.reduce((x > 0, y > 0))
-    x = x[index]
-    y = y[index]
     slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
     print(slope, intercept, r_value, r_value ** 2, p_value, std_err)
     plot_regression(
@@ -113,9 +151,43 @@ def plot_aod_regression_month(ym):
         y_range=y_range,
         # x_interval=x_interval,
         # y_interval=y_interval,
+        mode=mode,
+        bin_size=0.01,
     )
 
 
+def update_regression_stats():
+    """
+    把匹配结果列存储中还没有累加的 granule 补充到回归统计量中
+    """
+    regression_stats = RegressionStats(regression_stats_file)
+    matchup_store = MatchupStore(matchup_store_dir, matchup_pair)
+    count = 0
+    for result_file in matchup_store.get_files():
+        granule = os.path.splitext(os.path.basename(result_file))[0]
+        if regression_stats.has_granule(granule):
+            continue
+        result_data = pd.read_parquet(result_file, columns=['aod_s1', 'aod_s2', 'dt_s1', 'name'])
+        regression_stats.update(result_data['aod_s1'], result_data['aod_s2'], result_data['dt_s1'],
+                                result_data['name'], granule=granule)
+        count += 1
+    regression_stats.save()
+    print(f'回归统计量：累加 {count} 个 granule，共 {regression_stats.granule_count()} 个')
+    return regression_stats
+
+
+def print_regression_stats(freq='M', by_site=False):
+    """
+    输出每天 / 每月 / 每年的回归系数，只读取回归统计量状态文件
+    :param freq: 'D', 'M' 或者 'Y'
+    :param by_site: 同时按站点分组
+    """
+    regression_stats = RegressionStats(regression_stats_file)
+    coefficients = regression_stats.get_period_coefficients(freq, by_site=by_site)
+    print(coefficients.to_string())
+    return coefficients
+
+
 def main():
     ym = '201902'
     plot_aod_regression_month(ym)
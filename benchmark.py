@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+性能测试，使用合成数据，不依赖真实的卫星和站点数据
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib import hdf_reader
+from lib.aeronet import Aeronet
+
+benchmark_dir = os.path.join(tempfile.gettempdir(), 'geo_data_verification_benchmark')
+
+
+def make_sure_path_exists(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """
+    :return: (最短耗时, 结果)
+    """
+    cost = list()
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func(*args, **kwargs)
+        cost.append(time.perf_counter() - t)
+    return min(cost), result
+
+
+def make_aeronet_file(out_file, row_count, site_name='Benchmark_Site'):
+    """
+    生成合成的 AERONET ALL_POINTS 文件，6 行文件头 + 数据
+    """
+    if os.path.isfile(out_file):
+        return out_file
+    make_sure_path_exists(os.path.dirname(out_file))
+    rng = np.random.default_rng(0)
+    seconds = np.sort(rng.integers(0, 86400 * 365 * 10, row_count))
+    dts = pd.Timestamp('2010-01-01') + pd.to_timedelta(seconds, unit='s')
+    data = {
+        'AERONET_Site': site_name,
+        'Date(dd:mm:yyyy)': dts.strftime('%d:%m:%Y'),
+        'Time(hh:mm:ss)': dts.strftime('%H:%M:%S'),
+        'Day_of_Year': dts.dayofyear,
+    }
+    for wavelength in (1640, 1020, 870, 865, 779, 675, 667, 620, 560, 555, 551, 532, 531, 510, 500, 490, 443,
+                       440, 412, 400, 380, 340):
+        data[f'AOD_{wavelength}nm'] = np.where(rng.random(row_count) < 0.3, -999., rng.random(row_count))
+    for angstrom in ('440-870', '380-500', '440-675', '500-870', '340-440', '440-675[Polar]'):
+        data[f'{angstrom}_Angstrom_Exponent'] = rng.random(row_count) + 0.5
+    data['AERONET_Site_Name'] = site_name
+    data['Site_Latitude(Degrees)'] = 30.
+    data['Site_Longitude(Degrees)'] = 110.
+    data['Site_Elevation(m)'] = 10.
+    with open(out_file, 'w') as fp:
+        for i in range(6):
+            fp.write(f'AERONET benchmark header {i}\n')
+        pd.DataFrame(data).to_csv(fp, index=False)
+    print(f'生成合成 AERONET 文件：{out_file}')
+    return out_file
+
+
+def benchmark_aeronet_datetime(row_count=500000):
+    """
+    Aeronet.get_datetime：向量化字节切片 vs 逐行 apply + strptime
+    """
+    aeronet_file = make_aeronet_file(os.path.join(benchmark_dir, 'aeronet', f'{row_count}.lev20'), row_count)
+    aeronet = Aeronet(aeronet_file)
+    cost_new, dts_new = timeit(aeronet.get_datetime)
+    cost_old, dts_old = timeit(aeronet.get_datetime_apply, repeat=1)
+    assert (dts_new.to_numpy() == pd.to_datetime(dts_old).to_numpy()).all()
+    print(f'get_datetime  行数：{row_count}  apply：{cost_old:.3f}s  向量化：{cost_new:.3f}s  '
+          f'加速：{cost_old / cost_new:.1f}x')
+
+
+def make_modis_cpp_file(out_file, shape=(2030, 1354)):
+    """
+    生成合成的 MOD06_L2 HDF4 文件：经纬度 float32，云顶温度 int16 + scale_factor/add_offset
+    """
+    if os.path.isfile(out_file):
+        return out_file
+    from pyhdf.SD import SD, SDC
+    make_sure_path_exists(os.path.dirname(out_file))
+    rng = np.random.default_rng(0)
+    lons, lats = np.meshgrid(np.linspace(105, 115, shape[1]), np.linspace(35, 25, shape[0]))
+    datasets = [
+        ('Longitude', lons.astype(np.float32), SDC.FLOAT32, [-180., 180.], 1., 0.),
+        ('Latitude', lats.astype(np.float32), SDC.FLOAT32, [-90., 90.], 1., 0.),
+        ('Cloud_Top_Temperature', rng.integers(-1000, 20000, shape).astype(np.int16), SDC.INT16, [0, 20000],
+         0.01, -15000.),
+    ]
+    hdf = SD(out_file, SDC.WRITE | SDC.CREATE | SDC.TRUNC)
+    for name, data, sd_type, valid_range, slope, intercept in datasets:
+        dataset = hdf.create(name, sd_type, data.shape)
+        dataset[:] = data
+        dataset.valid_range = valid_range
+        dataset.scale_factor = slope
+        dataset.add_offset = intercept
+        dataset.endaccess()
+    hdf.end()
+    print(f'生成合成 HDF4 文件：{out_file}')
+    return out_file
+
+
+def read_hdf4_legacy(hdf4_file, data_name, rows=None, step=1):
+    """
+    原来的读取方式：每个数据集打开一次文件，读取整个数据集，float64 掩码和线性变换后再切片
+    """
+    from pyhdf.SD import SD, SDC
+    hdf = SD(hdf4_file, SDC.READ)
+    dataset = hdf.select(data_name)
+    data = dataset.get().astype(np.float64)
+    attrs = dataset.attributes()
+    valid_range = attrs['valid_range']
+    data[np.logical_or(data < valid_range[0], data > valid_range[1])] = np.nan
+    data = data * attrs['scale_factor'] + attrs['add_offset']
+    hdf.end()
+    if rows is None:
+        rows = (None, None)
+    return data[rows[0]:rows[1]:step, ::step]
+
+
+def benchmark_hdf4_read(shape=(2030, 1354)):
+    """
+    HDF4 读取：原来的读取方式 vs hdf_reader（句柄复用 + get(start, count, stride) + float32 原地解码）
+    每次读取前清空 hdf_reader 的缓存，只比较读取和解码
+    """
+    hdf4_file = make_modis_cpp_file(os.path.join(benchmark_dir, 'hdf4', 'MOD06_L2.A2020004.0755.061.hdf'), shape)
+    names = ('Longitude', 'Latitude', 'Cloud_Top_Temperature')
+
+    def read_legacy(rows, step):
+        return [read_hdf4_legacy(hdf4_file, name, rows, step) for name in names]
+
+    def read_new(rows, step):
+        hdf_reader.close_all()
+        return [hdf_reader.get_hdf4_data(hdf4_file, name, rows=rows, step=step) for name in names]
+
+    for rows, step in ((None, 1), ((shape[0] // 4, shape[0] // 2), 1), (None, 5)):
+        cost_old, data_old = timeit(read_legacy, rows, step)
+        cost_new, data_new = timeit(read_new, rows, step)
+        for old, new in zip(data_old, data_new):
+            np.testing.assert_allclose(new, old, rtol=1e-5, equal_nan=True)
+        print(f'read_hdf4  行：{rows}  步长：{step}  原来：{cost_old:.3f}s  hdf_reader：{cost_new:.3f}s  '
+              f'加速：{cost_old / cost_new:.1f}x')
+    hdf_reader.close_all()
+
+
+def make_aod_result_dir(out_dir, file_count, row_count=20):
+    """
+    生成合成的 aod_v01_verification 匹配结果 csv 文件夹，每个 granule 一个文件
+    """
+    if os.path.isdir(out_dir) and len(os.listdir(out_dir)) == file_count:
+        return out_dir
+    make_sure_path_exists(out_dir)
+    rng = np.random.default_rng(0)
+    for i in range(file_count):
+        dt = pd.Timestamp('2019-02-01') + pd.Timedelta(minutes=5 * i)
+        aod_s1 = rng.random(row_count)
+        result = pd.DataFrame({
+            'lons_s1': rng.uniform(-180, 180, row_count),
+            'lats_s1': rng.uniform(-90, 90, row_count),
+            'aod_s1': aod_s1,
+            'dt_s1': dt,
+            'lons_s2': rng.uniform(-180, 180, row_count),
+            'lats_s2': rng.uniform(-90, 90, row_count),
+            'name': 'Benchmark_Site',
+            'dist': rng.random(row_count) * 0.1,
+            'aod_s2': np.where(rng.random(row_count) < 0.1, np.nan, aod_s1 + rng.normal(0, 0.05, row_count)),
+            'dt_s2': dt + pd.Timedelta(minutes=3),
+        })
+        result.to_csv(os.path.join(out_dir, f'FY3D_MERSI_AOD_GRANULE_{dt:%Y%m%d_%H%M}.csv'))
+    print(f'生成合成匹配结果：{out_dir} {file_count} 个文件')
+    return out_dir
+
+
+def load_result_files_legacy(result_files):
+    """
+    原来的读取方式：逐个读取全部列，每个文件合并一次
+    """
+    result_data_all = None
+    for result_file in result_files:
+        result_data = pd.read_csv(result_file)
+        result_data = result_data.dropna(axis=0)
+        if result_data_all is None:
+            result_data_all = result_data
+        else:
+            result_data_all = pd.concat((result_data_all, result_data), axis=0)
+    x = result_data_all['aod_s1'].to_numpy()
+    y = result_data_all['aod_s2'].to_numpy()
+    return result_data_all[np.logical_and.reduce((x > 0, y > 0))]
+
+
+def benchmark_aod_result_loading(file_count=3000):
+    """
+    aod_v02_plot 读取匹配结果：逐个读取 + 重复 concat vs 多线程只读两列 + 一次 concat
+    """
+    from aod_v02_plot import load_result_files
+
+    result_dir = make_aod_result_dir(os.path.join(benchmark_dir, 'aod_result', str(file_count)), file_count)
+    result_files = [os.path.join(result_dir, filename) for filename in sorted(os.listdir(result_dir))]
+    cost_old, data_old = timeit(load_result_files_legacy, result_files, repeat=1)
+    cost_new, data_new = timeit(load_result_files, result_files)
+    np.testing.assert_allclose(data_new['aod_s1'].to_numpy(), data_old['aod_s1'].to_numpy(), rtol=1e-6)
+    np.testing.assert_allclose(data_new['aod_s2'].to_numpy(), data_old['aod_s2'].to_numpy(), rtol=1e-6)
+    print(f'load_result_files  文件数：{file_count}  原来：{cost_old:.3f}s  多线程：{cost_new:.3f}s  '
+          f'加速：{cost_old / cost_new:.1f}x')
+
+
+def benchmark_density(kde_count=5000, count=3000000):
+    """
+    散点密度：stats.gaussian_kde vs 二维直方图 / FFT 网格核密度估计
+    """
+    from scipy import stats
+    from lib.density import get_density
+
+    rng = np.random.default_rng(0)
+    x = rng.gamma(2, 0.15, count)
+    y = x * 0.9 + rng.normal(0, 0.05, count)
+    cost_kde, density_kde = timeit(get_density, x[:kde_count], y[:kde_count], method='kde', repeat=1)
+    for method in ('hist', 'fft'):
+        cost, density = timeit(get_density, x[:kde_count], y[:kde_count], method=method)
+        r = stats.spearmanr(density, density_kde)[0]
+        cost_all, _ = timeit(get_density, x, y, method=method, x_range=(0, 1.2), y_range=(0, 1.2), repeat=1)
+        print(f'get_density {method}  点数：{kde_count}  kde：{cost_kde:.3f}s  {method}：{cost:.3f}s  '
+              f'和 kde 的秩相关：{r:.3f}  点数：{count}  {method}：{cost_all:.3f}s')
+
+
+if __name__ == '__main__':
+    benchmark_aeronet_datetime()
+    benchmark_hdf4_read()
+    benchmark_aod_result_loading()
+    benchmark_density()
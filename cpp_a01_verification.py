@@ -3,14 +3,17 @@
 # @Time    : 2020-07-23 10:20
 # @Author  : NingAnMe <ninganme@qq.com>
 import os
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from datetime import timedelta
 import pandas as pd
 import numpy as np
 
 from lib.cpp import CppFy3c, CppModis
+from lib.kdtree_cache import KdtreeCache
+from lib.matchup_store import MatchupStore
+from lib.pairing import FootprintCache, pair_granules
 from lib.plot import plot_regression
-from lib.verification import Verification
+from lib.product import fy3c_virr_cpp_datetime, modis_mod06_datetime
+from lib.verification import Verification, get_overlap, clip_to_overlap, get_valid_lon_lat_mask
 
 fy3c_cpp_file = os.path.join('test', 'fy3c_cpp', 'FY3C_VIRRD_ORBT_L2_CPP_MLT_NUL_20200104_0000_1000M_MS.HDF')
 fy3c_geo_file = os.path.join('test', 'fy3c_cpp', 'FY3C_VIRRX_GBAL_L1_20200104_0000_GEOXX_MS.HDF')
@@ -29,7 +32,13 @@ def save_result(result, out_file):
         r.to_hdf(out_file, key='result')
 
 
-def verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file):
+def verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file, kdtree_cache=None, block_rows=None, modis_1km=False):
+    """
+    :param kdtree_cache: lib.kdtree_cache.KdtreeCache，None 时两侧都裁剪到重叠区域；
+        否则对整个 FY-3C 轨道建模并缓存，只裁剪 MODIS 一侧（见 main 的 use_kdtree_cache）
+    :param block_rows: None 时一次查询整个 MODIS 轨道，否则每 block_rows 行分块查询，限制峰值内存
+    :param modis_1km: 使用 MODIS 1km 云顶温度和插值得到的 1km 经纬度，否则使用 5km 数据
+    """
     # 获取数据1
     cpp1 = CppFy3c(in_file=fy3c_cpp_file, geo_file=fy3c_geo_file)
     lons1, lats1 = cpp1.get_lon_lat()
@@ -40,21 +49,54 @@ def verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file):
 
     # 获取数据2
     cpp2 = CppModis(in_file=modis_cpp_file, geo_file=modis_cpp_file)
-    lons2, lats2 = cpp2.get_lon_lat()
-    c_tmp2 = cpp2.get_ctop_temperature()
+    if modis_1km:
+        lons2, lats2 = cpp2.get_lon_lat_1km()
+        c_tmp2 = cpp2.get_ctop_temperature_1km()
+    else:
+        lons2, lats2 = cpp2.get_lon_lat()
+        c_tmp2 = cpp2.get_ctop_temperature()
+    cpp1.close()
+    cpp2.close()
     print_info(lons2)
     print_info(lats2)
     print_info(c_tmp2)
 
+    # 剔除距离差距过大的点
+    pre_dist = 0.01
+
+    # 只保留两个轨道的重叠区域
+    overlap = get_overlap(lons1, lats1, lons2, lats2, margin=pre_dist)
+    if overlap is None:
+        print('两个轨道没有重叠区域')
+        return
+    if kdtree_cache is None:
+        clip1 = clip_to_overlap(lons1, lats1, overlap, c_tmp1)
+        if clip1 is None:
+            print('两个轨道没有重叠区域')
+            return
+        lons1, lats1, c_tmp1 = clip1
+    else:
+        # 使用缓存时 FY-3C 不裁剪：裁剪范围取决于配对的 MODIS granule，缓存键会随之变化，永远不会命中；
+        # 对整个轨道的有效经纬度建模，只裁剪 MODIS（查询）一侧
+        valid1 = get_valid_lon_lat_mask(lons1, lats1)
+        lons1 = np.where(valid1, lons1, np.nan)
+        lats1 = np.where(valid1, lats1, np.nan)
+    clip2 = clip_to_overlap(lons2, lats2, overlap, c_tmp2)
+    if clip2 is None:
+        print('两个轨道没有重叠区域')
+        return
+    lons2, lats2, c_tmp2 = clip2
+
+    if block_rows is not None:
+        return verification_blocks(lons1, lats1, c_tmp1, lons2, lats2, c_tmp2, pre_dist, block_rows, kdtree_cache)
+
     # data2 KDtree建模
-    verif = Verification(lons1, lats1, lons2, lats2)
+    verif = Verification(lons1, lats1, lons2, lats2, kdtree_cache=kdtree_cache)
     if not verif.get_kdtree():
         return
 
-    verif.get_dist_and_index_kdtree()
+    verif.get_dist_and_index_kdtree(pre_dist=pre_dist)
 
-    # 剔除距离差距过大的点
-    pre_dist = 0.01
     index_dist = verif.get_index_dist(pre_dist=pre_dist)
 
     if index_dist.sum() > 0:
@@ -71,6 +113,32 @@ def verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file):
         return
 
 
+def verification_blocks(lons1, lats1, c_tmp1, lons2, lats2, c_tmp2, pre_dist, block_rows, kdtree_cache=None):
+    """
+    分块流式匹配，每块只保留符合距离阈值的数据
+    """
+    verif = Verification(lons1, lats1, None, None, kdtree_cache=kdtree_cache)
+    if not verif.get_kdtree():
+        return
+
+    result = {k: list() for k in ('lon_s1', 'lat_s1', 'tmp_s1', 'lon_s2', 'lat_s2', 'tmp_s2')}
+    for match in verif.iter_matches(lons2, lats2, pre_dist, block_rows=block_rows):
+        index_kdtree = match['index_kdtree']
+        index_query = match['index_query']
+        result['lon_s1'].append(verif.get_kdtree_data_by_index(lons1, index_kdtree))
+        result['lat_s1'].append(verif.get_kdtree_data_by_index(lats1, index_kdtree))
+        result['tmp_s1'].append(verif.get_kdtree_data_by_index(c_tmp1, index_kdtree))
+        result['lon_s2'].append(lons2[index_query])
+        result['lat_s2'].append(lats2[index_query])
+        result['tmp_s2'].append(c_tmp2[index_query])
+
+    if len(result['lon_s1']) == 0:
+        return
+    result = {k: np.concatenate(v) for k, v in result.items()}
+    print(f'符合距离阈值的数据量=========：{len(result["lon_s1"])}')
+    return result
+
+
 # fy3c_cpp_dir = '/home/kts_project_v1/qiuh/mod_cpp/20200104/20200104'
 # fy3c_geo_dir = '/DISK/DATA02/PROJECT/SourceData/FENGYUN-3C/VIRR/L1/ORBIT/20200104'
 # modis_cpp_dir = '/home/kts_project_v1/qiuh/mod_cpp/modis_cpp_20200104/MOD06_L2/2020/004'
@@ -79,66 +147,116 @@ fy3c_cpp_dir = r'test/fy3c_cpp'
 fy3c_geo_dir = 'test/fy3c_geo'
 modis_cpp_dir = 'test/modis_cpp'
 result_dir = 'test/result'
+kdtree_cache_dir = 'test/kdtree_cache'
+footprint_cache_dir = 'test/footprint_cache'
+matchup_store_dir = 'test/matchup_store'
+matchup_pair = 'FY3C_VIRR+MODIS'
+
+
+def get_fy3c_geo_file(fy3c_cpp_file):
+    """
+    FY3C_VIRRD_ORBT_L2_CPP_MLT_NUL_20200104_0000_1000M_MS.HDF -> FY3C_VIRRX_GBAL_L1_20200104_0000_GEOXX_MS.HDF
+    """
+    ymd, hm = os.path.basename(fy3c_cpp_file).split('_')[7:9]
+    return os.path.join(fy3c_geo_dir, f'FY3C_VIRRX_GBAL_L1_{ymd}_{hm}_GEOXX_MS.HDF')
+
+
+def get_granule_name(dt1, dt2):
+    return f"FY3C+MERSI_{dt1:%Y%m%d%H%M}_TREEA+MODIS_{dt2:%Y%m%d%H%M}"
 
 
-def main():
-    fy3c_cpp_filenames = os.listdir(fy3c_cpp_dir)
-    fy3c_cpp_filenames = [i for i in fy3c_cpp_filenames if i[-3:] == 'HDF']
-
-    modis_cpp_filenames = os.listdir(modis_cpp_dir)
-
-    pairs = list()
-
-    for fy3c_cpp_filename in fy3c_cpp_filenames:
-        ymd1 = '20200330'
-        hm1 = fy3c_cpp_filename.split('_')[8]
-        ymdhm1 = ymd1 + hm1
-        dt1 = datetime.strptime(ymdhm1, '%Y%m%d%H%M')
-        dt_s = dt1 - relativedelta(minutes=10)
-        dt_e = dt1 + relativedelta(minutes=10)
-        for modis_cpp_filename in modis_cpp_filenames:
-            hm2 = modis_cpp_filename.split('.')[2]
-            ymdhm2 = ymd1 + hm2
-            dt2 = datetime.strptime(ymdhm2, '%Y%m%d%H%M')
-            if dt_s <= dt2 <= dt_e:
-                cpp_file1 = os.path.join(fy3c_cpp_dir, fy3c_cpp_filename)
-                geo_file1 = os.path.join(fy3c_geo_dir, f'FY3C_VIRRX_GBAL_L1_{ymd1}_{hm1}_GEOXX_MS.HDF')
-                cpp_file2 = os.path.join(modis_cpp_dir, modis_cpp_filename)
-                result_file = os.path.join(result_dir, f"FY3C+MERSI_{ymdhm1}_TREEA+MODIS_{ymdhm2}.HDF")
-                # print(fy3c_cpp_filename, modis_cpp_filename)
-                pairs.append((cpp_file1, geo_file1, cpp_file2, result_file))
-    # print(pairs)
-    print(len(pairs))
-    pairs.sort()
-    for fy3c_cpp_file, fy3c_geo_file, modis_cpp_file, result_file in pairs:
-        result = verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file)
-        if result is not None:
+def get_fy3c_lon_lat(fy3c_cpp_file):
+    return CppFy3c(in_file=fy3c_cpp_file, geo_file=get_fy3c_geo_file(fy3c_cpp_file)).get_lon_lat(step=10)
+
+
+def get_modis_lon_lat(modis_cpp_file):
+    return CppModis(in_file=modis_cpp_file).get_lon_lat()
+
+
+def main(window_minutes=10, check_footprint=False, use_store=True, use_kdtree_cache=False):
+    """
+    :param window_minutes: 两个 granule 的最大时间差(分钟)
+    :param check_footprint: 同时要求两个 granule 的经纬度范围重叠
+    :param use_store: 结果写入匹配结果列存储，否则每对 granule 输出一个 HDF 文件
+    :param use_kdtree_cache: 缓存 FY-3C 的 KDtree。缓存时 FY-3C 不能裁剪到重叠区域（缓存键会随 MODIS granule 变化），
+        需要对整个轨道建模，每个 FY-3C granule 的缓存文件约 100MB 以上；
+        只有同一个 FY-3C granule 和多个 MODIS granule 配对时才划算，默认两侧都裁剪到重叠区域，不缓存
+    """
+    fy3c_cpp_files = [os.path.join(fy3c_cpp_dir, i) for i in os.listdir(fy3c_cpp_dir) if i[-3:] == 'HDF']
+    modis_cpp_files = [os.path.join(modis_cpp_dir, i) for i in os.listdir(modis_cpp_dir)]
+
+    footprint_cache1 = footprint_cache2 = None
+    if check_footprint:
+        footprint_cache1 = FootprintCache(get_fy3c_lon_lat, os.path.join(footprint_cache_dir, 'FY3C_VIRR.csv'))
+        footprint_cache2 = FootprintCache(get_modis_lon_lat, os.path.join(footprint_cache_dir, 'MODIS.csv'))
+    granule_pairs = pair_granules(
+        fy3c_cpp_files, modis_cpp_files, fy3c_virr_cpp_datetime, modis_mod06_datetime,
+        window=timedelta(minutes=window_minutes),
+        footprint_cache1=footprint_cache1, footprint_cache2=footprint_cache2, margin=0.01)
+
+    print(len(granule_pairs))
+    matchup_store = MatchupStore(matchup_store_dir, matchup_pair) if use_store else None
+    kdtree_cache = KdtreeCache(kdtree_cache_dir) if use_kdtree_cache else None
+    for fy3c_cpp_file, dt1, modis_cpp_file, dt2 in granule_pairs:
+        granule = get_granule_name(dt1, dt2)
+        if matchup_store is not None and matchup_store.exists(granule, dt1):
+            print('输出已经存在：{}'.format(granule))
+            continue
+        fy3c_geo_file = get_fy3c_geo_file(fy3c_cpp_file)
+        result = verification(fy3c_cpp_file, fy3c_geo_file, modis_cpp_file, kdtree_cache=kdtree_cache)
+        if result is None:
+            continue
+        if matchup_store is None:
+            result_file = os.path.join(result_dir, granule + '.HDF')
             save_result(result, result_file)
             print(result_file)
+        else:
+            result = pd.DataFrame(result).dropna(axis=0)
+            result['dt_s1'] = dt1
+            result['dt_s2'] = dt2
+            print(matchup_store.write(result, granule, dt1))
+    if kdtree_cache is not None:
+        kdtree_cache.report()
+
 
+RESULT_COLUMNS = ['tmp_s1', 'tmp_s2']  # 绘图和统计只需要这两列
 
-def plot_cpp_regression():
-    result_files = os.listdir(result_dir)
-    for filename in result_files:
-        result_file = os.path.join(result_dir, filename)
-        result_data = pd.read_hdf(result_file)
-        result_data = pd.DataFrame(result_data)
-        print(type(result_data))
-        print(result_data.head())
+
+def iter_result_data(use_store=True, dt_s=None, dt_e=None):
+    """
+    逐个 granule 对读取匹配结果
+    :param use_store: 从匹配结果列存储读取（按 dt_s1, dt_s2 分组），否则读取 result_dir 中的 HDF 文件
+    :param dt_s: dt_s1 >= dt_s，只用于列存储
+    :param dt_e: dt_s1 < dt_e，只用于列存储
+    :return: 生成 (granule 名, DataFrame)，只返回超过 10 条数据的 granule 对
+    """
+    if use_store:
+        matchup_store = MatchupStore(matchup_store_dir, matchup_pair)
+        store_data = matchup_store.read(columns=RESULT_COLUMNS + ['dt_s1', 'dt_s2'], dt_s=dt_s, dt_e=dt_e)
+        results = ((get_granule_name(dt1, dt2), result_data[RESULT_COLUMNS])
+                   for (dt1, dt2), result_data in store_data.groupby(['dt_s1', 'dt_s2']))
+    else:
+        results = ((os.path.splitext(filename)[0], pd.DataFrame(pd.read_hdf(os.path.join(result_dir, filename))))
+                   for filename in os.listdir(result_dir))
+    for granule, result_data in results:
         result_data = result_data.dropna(axis=0)
         if len(result_data) <= 10:
-            print(f'数据数量小于10，无法绘图')
+            print(f'数据数量小于10，无法绘图：{granule}')
             continue
         print(result_data.head(2))
+        yield granule, result_data
 
-        title = os.path.splitext(filename)[0]
+
+def plot_cpp_regression(use_store=True, dt_s=None, dt_e=None):
+    for granule, result_data in iter_result_data(use_store, dt_s, dt_e):
+        title = granule
         x_label = 'FY3C+VIRR (K)'
         y_label = 'TERRA+MODIS (K)'
         x_range = [30, 170]
         y_range = [30, 170]
         x_interval = 20
         y_interval = 20
-        out_file = os.path.join('test', 'pictrue', filename+'.PNG')
+        out_file = os.path.join('test', 'pictrue', granule + '.PNG')
         plot_regression(
             x=result_data['tmp_s1'].to_numpy(),
             y=result_data['tmp_s2'].to_numpy(),
@@ -153,28 +271,16 @@ def plot_cpp_regression():
         )
 
 
-def plot_delta_regression():
-    result_files = os.listdir(result_dir)
-    for filename in result_files:
-        result_file = os.path.join(result_dir, filename)
-        result_data = pd.read_hdf(result_file)
-        result_data = pd.DataFrame(result_data)
-        print(type(result_data))
-        print(result_data.head())
-        result_data = result_data.dropna(axis=0)
-        if len(result_data) <= 10:
-            print(f'数据数量小于10，无法绘图')
-            continue
-        print(result_data.head(2))
-
-        title = os.path.splitext(filename)[0]
+def plot_delta_regression(use_store=True, dt_s=None, dt_e=None):
+    for granule, result_data in iter_result_data(use_store, dt_s, dt_e):
+        title = granule
         x_label = 'FY3C+VIRR (K)'
         y_label = 'MODIS-VIRR (K)'
         x_range = [30, 170]
         y_range = [-30, 30]
         x_interval = 20
         y_interval = 10
-        out_file = os.path.join('test', 'pictrue', filename+'_Delta.PNG')
+        out_file = os.path.join('test', 'pictrue', granule + '_Delta.PNG')
         x = result_data['tmp_s1'].to_numpy()
         y = x - result_data['tmp_s2'].to_numpy()
         plot_regression(
@@ -191,23 +297,12 @@ def plot_delta_regression():
         )
 
 
-def cal_mean_rate():
-    result_files = os.listdir(result_dir)
-    for filename in result_files:
-        result_file = os.path.join(result_dir, filename)
-        result_data = pd.read_hdf(result_file)
-        result_data = pd.DataFrame(result_data)
-        print(type(result_data))
-        print(result_data.head())
-        result_data = result_data.dropna(axis=0)
-        if len(result_data) <= 10:
-            print(f'数据数量小于10，无法绘图')
-            continue
-        print(result_data.head(2))
+def cal_mean_rate(use_store=True, dt_s=None, dt_e=None):
+    for granule, result_data in iter_result_data(use_store, dt_s, dt_e):
         d1_mean = result_data['tmp_s1'].to_numpy().mean()
         d2_mean = result_data['tmp_s2'].to_numpy().mean()
         r = (d1_mean - d2_mean) / d2_mean
-        out_file = os.path.join('test', 'pictrue', filename+'_Mean.txt')
+        out_file = os.path.join('test', 'pictrue', granule + '_Mean.txt')
         with open(out_file, 'w') as fp:
             fp.write(str(r))
             print('>>> {}'.format(out_file))
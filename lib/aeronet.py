@@ -2,25 +2,116 @@
 # -*- coding: utf-8 -*-
 # @Author  : NingAnMe <ninganme@qq.com>
 import os
+import numpy as np
 import pandas as pd
 """
 AERONET_Site_Name,Site_Latitude(Degrees),Site_Longitude(Degrees)
 """
 from datetime import datetime
 
+from lib.index_file import get_mtime_ns, write_index_file, read_index_file
+
+
+# 验证流程实际使用的列
+AERONET_USECOLS = [
+    'Date(dd:mm:yyyy)',
+    'Time(hh:mm:ss)',
+    'AOD_675nm',
+    '440-675_Angstrom_Exponent',
+    'AERONET_Site_Name',
+    'Site_Latitude(Degrees)',
+    'Site_Longitude(Degrees)',
+]
+AERONET_DTYPES = {
+    'Date(dd:mm:yyyy)': str,
+    'Time(hh:mm:ss)': str,
+    'AOD_675nm': np.float32,
+    '440-675_Angstrom_Exponent': np.float32,
+    'AERONET_Site_Name': 'category',
+    'Site_Latitude(Degrees)': np.float64,
+    'Site_Longitude(Degrees)': np.float64,
+}
+
+AERONET_CACHE_FORMAT = 'aeronet_site'  # AeronetStore 缓存文件的格式名和版本
+AERONET_CACHE_VERSION = 2  # 2: mtime 为整数纳秒
+
 
 def get_aod_550nm(aod_675, angstrom_440_675):
     return aod_675 * ((550 / 675) ** (-1 * angstrom_440_675))
 
 
+def parse_aeronet_datetime(dates, times):
+    """
+    向量化解析 AERONET 的日期和时间
+    按字节切片把 dd:mm:yyyy 和 hh:mm:ss 重新拼成 yyyy-mm-ddThh:mm:ss，再一次性转换为 datetime64
+    :param dates: "dd:mm:yyyy"
+    :param times: "hh:mm:ss"
+    :return: datetime64[ns]
+    """
+    d = np.asarray(dates, dtype='S10').view(np.uint8).reshape(-1, 10)
+    t = np.asarray(times, dtype='S8').view(np.uint8).reshape(-1, 8)
+    iso = np.empty((len(d), 19), dtype=np.uint8)
+    iso[:, 0:4] = d[:, 6:10]
+    iso[:, 4] = ord('-')
+    iso[:, 5:7] = d[:, 3:5]
+    iso[:, 7] = ord('-')
+    iso[:, 8:10] = d[:, 0:2]
+    iso[:, 10] = ord('T')
+    iso[:, 11:19] = t
+    return iso.view('S19').reshape(-1).astype('datetime64[s]').astype('datetime64[ns]')
+
+
 class Aeronet:
-    def __init__(self, in_file):
+    def __init__(self, in_file, usecols=None, dt_range=None, engine='c', chunksize=100000):
+        """
+        :param in_file: AERONET 站点文件
+        :param usecols: 只读取的列，例如 AERONET_USECOLS，None 时读取全部列
+        :param dt_range: (dt_s, dt_e)，只保留这个时间范围内的数据，分块读取时逐块过滤
+        :param engine: pandas.read_csv 的解析引擎，'c' 或 'pyarrow'
+        :param chunksize: 分块读取的行数，engine='pyarrow' 时不分块
+        """
         self.site_file = in_file
+        self.usecols = usecols
+        self.dt_range = dt_range
+        self.engine = engine
+        self.chunksize = chunksize
         self.datas = self.load_Aeronet_site_file(self.site_file)
 
     def load_Aeronet_site_file(self, in_file):
-        datas = pd.read_csv(in_file, skiprows=6, index_col=False)
-        return datas
+        if self.usecols is None:
+            dtype = {'Date(dd:mm:yyyy)': str, 'Time(hh:mm:ss)': str}
+        else:
+            dtype = {k: v for k, v in AERONET_DTYPES.items() if k in self.usecols}
+        kwargs = {
+            'usecols': self.usecols,
+            'dtype': dtype,
+            'engine': self.engine,
+        }
+        if self.engine == 'pyarrow':
+            kwargs['header'] = 6  # pyarrow 引擎的 skiprows 会把第一行文件头当成列名
+        else:
+            kwargs['skiprows'] = 6
+            kwargs['index_col'] = False
+
+        if self.dt_range is None:
+            return pd.read_csv(in_file, **kwargs)
+        if self.engine == 'pyarrow':
+            return self.__filter_dt_range(pd.read_csv(in_file, **kwargs))
+
+        chunks = list()
+        dt_e = np.datetime64(self.dt_range[1], 'ns')
+        for chunk in pd.read_csv(in_file, chunksize=self.chunksize, **kwargs):
+            chunks.append(self.__filter_dt_range(chunk))
+            # AERONET 文件按时间顺序排列，超过结束时间后不再读取
+            if parse_aeronet_datetime(chunk['Date(dd:mm:yyyy)'].iloc[-1:], chunk['Time(hh:mm:ss)'].iloc[-1:])[0] > dt_e:
+                break
+        return pd.concat(chunks, ignore_index=True)
+
+    def __filter_dt_range(self, datas):
+        dts = parse_aeronet_datetime(datas['Date(dd:mm:yyyy)'], datas['Time(hh:mm:ss)'])
+        dt_s = np.datetime64(self.dt_range[0], 'ns')
+        dt_e = np.datetime64(self.dt_range[1], 'ns')
+        return datas[np.logical_and(dts >= dt_s, dts <= dt_e)].reset_index(drop=True)
 
     def get_site_name_lon_lat(self):
         d = self.datas
@@ -32,13 +123,264 @@ class Aeronet:
         dt = datetime.strptime(d+t, '%d:%m:%Y%H:%M:%S')
         return dt
 
-    def get_datetime(self):
+    def get_datetime_apply(self):
         """
-        "Date(dd:mm:yyyy),Time(hh:mm:ss)"
+        逐行 strptime，速度慢，只用于和 get_datetime 做对比
         :return:
         """
         dts = self.datas.apply(self.__datetime2datetime, axis=1)
         return dts
 
+    def get_datetime(self):
+        """
+        "Date(dd:mm:yyyy),Time(hh:mm:ss)"
+        :return:
+        """
+        dts = parse_aeronet_datetime(self.datas['Date(dd:mm:yyyy)'], self.datas['Time(hh:mm:ss)'])
+        return pd.Series(dts, index=self.datas.index)
+
     def get_aod550(self):
         return get_aod_550nm(self.datas['AOD_675nm'], self.datas['440-675_Angstrom_Exponent'])
+
+
+def get_aeronet_site_name(aeronet_filename):
+    """
+    19930101_20200704_Ascension_Island.lev20 -> Ascension_Island
+    """
+    return '_'.join(os.path.splitext(aeronet_filename)[0].split('_')[2:])
+
+
+class AeronetCatalog:
+    """
+    AERONET 站点目录：站点名 -> 站点文件、经纬度、观测时间范围
+    每次运行只列一次目录，解析结果保存到 catalog_file（和 site_info.csv 同样的列，另加 file 和 mtime(ns)），
+    之后只重新解析新增或者 mtime 变化的站点文件
+    """
+    columns = ['name', 'lon', 'lat', 'dt_s', 'dt_e', 'file', 'mtime']
+
+    def __init__(self, aeronet_dir, catalog_file=None):
+        self.aeronet_dir = aeronet_dir
+        self.catalog_file = catalog_file
+        self.sites = self.load_catalog()
+        self.update()
+
+    def load_catalog(self):
+        if self.catalog_file is None or not os.path.isfile(self.catalog_file):
+            return pd.DataFrame(columns=self.columns).set_index('name')
+        sites = pd.read_csv(self.catalog_file, index_col=False, parse_dates=['dt_s', 'dt_e'])
+        return sites[self.columns].set_index('name')
+
+    @classmethod
+    def parse_site_file(cls, site_file):
+        aeronet = Aeronet(site_file, usecols=AERONET_USECOLS)
+        _, lon, lat = aeronet.get_site_name_lon_lat()
+        dts = aeronet.get_datetime()
+        return lon, lat, dts.min(), dts.max()
+
+    def update(self):
+        """
+        同步站点目录和 AERONET 文件夹
+        """
+        records = list()
+        names = set()
+        changed = 0
+        for aeronet_filename in sorted(os.listdir(self.aeronet_dir)):
+            site_file = os.path.join(self.aeronet_dir, aeronet_filename)
+            if not os.path.isfile(site_file):
+                continue
+            name = get_aeronet_site_name(aeronet_filename)
+            if name in names:
+                print(f'站点名重复，跳过：{site_file}')
+                continue
+            names.add(name)
+            mtime = get_mtime_ns(site_file)
+            if name in self.sites.index and self.sites.at[name, 'file'] == site_file \
+                    and self.sites.at[name, 'mtime'] == mtime:
+                records.append((name, *self.sites.loc[name, self.columns[1:]]))
+                continue
+            try:
+                lon, lat, dt_s, dt_e = self.parse_site_file(site_file)
+            except Exception as why:
+                print(f'站点文件解析失败：{site_file} {why}')
+                continue
+            print("{:20} {} {}".format(name, dt_s, dt_e))
+            records.append((name, lon, lat, dt_s, dt_e, site_file, mtime))
+            changed += 1
+        removed = len(set(self.sites.index) - names)
+        self.sites = pd.DataFrame(records, columns=self.columns).set_index('name')
+        print(f'AERONET站点目录：{len(self.sites)} 个站点，更新 {changed} 个，删除 {removed} 个')
+        if self.catalog_file is not None and (changed > 0 or removed > 0):
+            self.sites.to_csv(self.catalog_file)
+            print('>>> {}'.format(self.catalog_file))
+
+    def get_file(self, name):
+        """
+        :param name: AERONET 站点名
+        :return: 站点文件，没有这个站点时返回 None
+        """
+        if name not in self.sites.index:
+            return
+        return self.sites.at[name, 'file']
+
+
+class AeronetSiteIndex:
+    """
+    站点观测时间范围的区间索引，按 dt_s 排序后二分查找，只返回在某个时刻有观测的站点
+    """
+
+    def __init__(self, site_info):
+        """
+        :param site_info: DataFrame，包含 name, lon, lat, dt_s, dt_e 列（site_info.csv 或者 AeronetCatalog.sites）
+        """
+        site_info = site_info.reset_index()
+        dt_s = pd.to_datetime(site_info['dt_s']).to_numpy(dtype='datetime64[ns]')
+        order = np.argsort(dt_s, kind='stable')
+        self.dt_s = dt_s[order]
+        self.dt_e = pd.to_datetime(site_info['dt_e']).to_numpy(dtype='datetime64[ns]')[order]
+        self.names = site_info['name'].to_numpy()[order]
+        self.lons = site_info['lon'].to_numpy(dtype=np.float64)[order]
+        self.lats = site_info['lat'].to_numpy(dtype=np.float64)[order]
+
+    @classmethod
+    def from_csv(cls, site_info_file):
+        return cls(pd.read_csv(site_info_file, index_col=False))
+
+    def query(self, dt, pre_dts=np.timedelta64(30, 'm'), box=None):
+        """
+        :param dt: 卫星观测时间
+        :param pre_dts: 时间阈值，观测时间范围前后各放宽 pre_dts
+        :param box: (lon_min, lon_max, lat_min, lat_max)，只保留范围内的站点
+        :return: (names, lons, lats)
+        """
+        dt = np.datetime64(dt, 'ns')
+        pre_dts = np.timedelta64(pre_dts, 'ns')
+        count = np.searchsorted(self.dt_s, dt + pre_dts, side='right')
+        index = np.arange(count)[self.dt_e[:count] >= dt - pre_dts]
+        if box is not None:
+            lon_min, lon_max, lat_min, lat_max = box
+            lons = self.lons[index]
+            lats = self.lats[index]
+            index = index[(lons >= lon_min) & (lons <= lon_max) & (lats >= lat_min) & (lats <= lat_max)]
+        print(f'站点总数：{len(self.names)} 时间范围内：{count} 有效站点：{len(index)}')
+        return self.names[index], self.lons[index], self.lats[index]
+
+
+class AeronetStore:
+    """
+    AERONET 站点时间序列缓存
+    每个站点文件只解析一次，保存为按时间排序的 datetime64[ns] 和 AOD550 两列，
+    并写入列存储缓存文件（源文件 mtime 变化后自动重新解析）
+    """
+
+    def __init__(self, catalog, cache_dir=None):
+        """
+        :param catalog: AeronetCatalog
+        :param cache_dir: 列存储缓存文件夹，None 时不缓存到磁盘
+        """
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.sites = dict()  # name: (dts, aod550)
+
+    def __cache_file(self, name):
+        return os.path.join(self.cache_dir, name + '.idx')
+
+    def __load_cache(self, name, mtime):
+        cache_file = self.__cache_file(name)
+        if not os.path.isfile(cache_file):
+            return
+        try:
+            arrays, scalars = read_index_file(cache_file, AERONET_CACHE_FORMAT, AERONET_CACHE_VERSION)
+        except ValueError as why:
+            print(f'AERONET缓存读取失败：{cache_file} {why}')
+            return
+        if scalars['mtime'] != mtime:
+            return
+        return arrays['dts'], arrays['aod550']
+
+    def __parse(self, site_file):
+        aeronet = Aeronet(site_file, usecols=AERONET_USECOLS)
+        dts = pd.to_datetime(aeronet.get_datetime()).to_numpy(dtype='datetime64[ns]')
+        aod550 = aeronet.get_aod550().to_numpy(dtype=np.float32)
+        index = np.argsort(dts, kind='stable')
+        return dts[index], aod550[index]
+
+    def get_site(self, name):
+        """
+        获取站点时间序列
+        :param name: AERONET 站点名
+        :return: (dts, aod550) 或者 None
+        """
+        if name in self.sites:
+            return self.sites[name]
+        site_file = self.catalog.get_file(name)
+        if site_file is None:
+            print(f'没有找到站点文件：{name}')
+            return
+        mtime = get_mtime_ns(site_file)
+        site = None
+        if self.cache_dir is not None:
+            site = self.__load_cache(name, mtime)
+        if site is None:
+            site = self.__parse(site_file)
+            if self.cache_dir is not None:
+                write_index_file(self.__cache_file(name), {'dts': site[0].view(np.int64), 'aod550': site[1]},
+                                 {'mtime': mtime}, AERONET_CACHE_FORMAT, AERONET_CACHE_VERSION)
+        else:
+            site = (site[0].view('datetime64[ns]'), site[1])
+        self.sites[name] = site
+        return site
+
+    def match(self, names, dt, pre_dts=np.timedelta64(30, 'm')):
+        """
+        获取多个站点在 dt 时刻前后 pre_dts 内最接近的观测
+        :param names: 站点名
+        :param dt: 卫星观测时间
+        :param pre_dts: 时间阈值
+        :return: (aod550, dts)，超过时间阈值的 aod550 为 nan，没有站点文件的 dts 为 NaT
+        """
+        dt = np.datetime64(dt, 'ns')
+        pre_dts = np.timedelta64(pre_dts, 'ns')
+        aod550 = np.full(len(names), np.nan, dtype=np.float32)
+        dts = np.full(len(names), np.datetime64('NaT'), dtype='datetime64[ns]')
+        if len(names) == 0:
+            return aod550, dts
+
+        # 同一个站点只查找一次：在 memmap 的时间序列上二分查找，不复制数据
+        site_names, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        site_dts = np.full(len(site_names), np.datetime64('NaT'), dtype='datetime64[ns]')
+        site_aod550 = np.full(len(site_names), np.nan, dtype=np.float32)
+        for i, name in enumerate(site_names):
+            site = self.get_site(name)
+            if site is None or len(site[0]) == 0:
+                continue
+            index = np.searchsorted(site[0], dt)
+            left, right = max(index - 1, 0), min(index, len(site[0]) - 1)
+            index = right if np.abs(site[0][right] - dt) < np.abs(site[0][left] - dt) else left
+            site_dts[i] = site[0][index]
+            site_aod550[i] = site[1][index]
+        dts[:] = site_dts[inverse]
+        in_time = ~np.isnat(dts) & (np.abs(dts - dt) < pre_dts)
+        aod550[in_time] = site_aod550[inverse][in_time]
+        return aod550, dts
+        site_dts = np.concatenate([site[0] for site, v in zip(sites, valid) if v])
+        site_aod550 = np.concatenate([site[1] for site, v in zip(sites, valid) if v])
+        lengths = lengths[valid]
+        starts = np.cumsum(lengths) - lengths
+        before = np.add.reduceat((site_dts < dt).astype(np.int64), starts)
+        left = starts + np.maximum(before - 1, 0)
+        right = starts + np.minimum(before, lengths - 1)
+        delta_left = np.abs(site_dts[left] - dt)
+        delta_right = np.abs(site_dts[right] - dt)
+        nearest = np.where(delta_right < delta_left, right, left)
+
+        site_index = np.full(len(site_names), -1)
+        site_index[valid] = nearest
+        index = site_index[inverse]
+        matched = index >= 0
+        dts[matched] = site_dts[index[matched]]
+        in_time = matched & (np.abs(dts - dt) < pre_dts)
+        aod550[in_time] = site_aod550[index[in_time]]
+        return aod550, dts
@@ -2,105 +2,50 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2020-07-23 10:11
 # @Author  : NingAnMe <ninganme@qq.com>
-import os
-import h5py
 import numpy as np
-from pyhdf.SD import SD, SDC
 
+from lib import hdf_reader
+from lib.geo_interp import interp_5km_to_1km
+from lib.product import ProductReader
 
-class CppFy3c:
-    def __init__(self, in_file, geo_file=None):
-        self.in_file = in_file
-        self.geo_file = geo_file
-        self.filename = os.path.basename(in_file)
 
-    @classmethod
-    def get_hdf5_data(cls, hdf5_file, data_name, slope=None, intercept=None, valid_range=None):
-        with h5py.File(hdf5_file, 'r') as hdf:
-            dataset = hdf.get(data_name)
-            if slope is None:
-                slope = dataset.attrs['Slope']
-            if intercept is None:
-                intercept = dataset.attrs['Intercept']
-            if valid_range is None:
-                valid_range = dataset.attrs['valid_range']
-            data = dataset[:].astype(np.float)
-            data[np.logical_or(data < valid_range[0], data > valid_range[1])] = np.nan
-            data = data * slope + intercept
-            return data
+class CppFy3c(ProductReader):
+    product = 'FY3C_VIRR_CPP'
 
-    def get_lon_lat(self):
-        lons = self.get_hdf5_data(self.geo_file, 'Geolocation/Longitude')
-        lats = self.get_hdf5_data(self.geo_file, 'Geolocation/Latitude')
-        return lons, lats
+    def get_ctop_temperature(self, rows=None, step=1):
+        return self.get('ctop_temperature', rows=rows, step=step)
 
-    def get_ctop_temperature(self):
-        return self.get_hdf5_data(self.in_file, '5-min granule Cloud Top Temperature', intercept=0)
+    def get_ctop_hight(self, rows=None, step=1):
+        return self.get('ctop_hight', rows=rows, step=step)
 
-    def get_ctop_hight(self):
-        return self.get_hdf5_data(self.in_file, '5-min granule Cloud Top Height')
 
+class CppModis(ProductReader):
+    product = 'MODIS_MOD06'
 
-class CppModis:
-    def __init__(self, in_file, geo_file=None):
-        self.in_file = in_file
-        self.geo_file = geo_file
-        self.filename = os.path.basename(in_file)
+    def get_lon_lat_1km(self, rows=None, step=1):
+        """
+        5km 经纬度插值得到的 1km 经纬度，每个 granule 只插值一次
+        :param rows: (start, stop)，1km 的行
+        :param step: 行列方向的采样步长
+        """
+        def make_lon_lat():
+            lons, lats = self.get_lon_lat()
+            return np.stack(interp_5km_to_1km(lons, lats))
 
-    @classmethod
-    def get_hdf4_data(cls, hdf4_file, data_name, slope=None, intercept=None, valid_range=None):
-        hdf = SD(hdf4_file, SDC.READ)
-        dataset = hdf.select(data_name)
-        if dataset is not None:
-            attrs = dataset.attributes()
-            if slope is None:
-                slope = attrs['scale_factor']
-            if intercept is None:
-                intercept = attrs['add_offset']
-            if valid_range is None:
-                valid_range = attrs['valid_range']
-            data = dataset.get().astype(np.float)
-            data[np.logical_or(data < valid_range[0], data > valid_range[1])] = np.nan
-            data = data * slope + intercept
-            return data
+        lon_lat = hdf_reader.get_derived_data(self.in_file, 'lon_lat_1km', make_lon_lat)
+        if rows is None:
+            rows = (None, None)
+        lon_lat = lon_lat[:, rows[0]:rows[1]:step, ::step]
+        return lon_lat[0], lon_lat[1]
 
-    def get_lon_lat(self):
-        lons = self.get_hdf4_data(self.in_file, 'Longitude')
-        lats = self.get_hdf4_data(self.in_file, 'Latitude')
-        return lons, lats
+    def get_ctop_temperature_1km(self, rows=None, step=1):
+        return self.get('ctop_temperature_1km', rows=rows, step=step)
 
-    def get_ctop_temperature(self):
-        return self.get_hdf4_data(self.in_file, 'Cloud_Top_Temperature', intercept=0)
+    def get_ctop_hight_1km(self, rows=None, step=1):
+        return self.get('ctop_hight_1km', rows=rows, step=step)
 
-    def get_ctop_hight(self):
-        return self.get_hdf4_data(self.in_file, 'Cloud_Top_Height')
+    def get_ctop_temperature(self, rows=None, step=1):
+        return self.get('ctop_temperature', rows=rows, step=step)
 
-
-class AodFy3d:
-    def __init__(self, in_file, geo_file=None):
-        self.in_file = in_file
-        self.geo_file = geo_file
-        self.filename = os.path.basename(in_file)
-
-    @classmethod
-    def get_hdf5_data(cls, hdf5_file, data_name, slope=None, intercept=None, valid_range=None):
-        with h5py.File(hdf5_file, 'r') as hdf:
-            dataset = hdf.get(data_name)
-            if slope is None:
-                slope = dataset.attrs['Slope']
-            if intercept is None:
-                intercept = dataset.attrs['Intercept']
-            if valid_range is None:
-                valid_range = dataset.attrs['valid_range']
-            data = dataset[:].astype(np.float)
-            data[np.logical_or(data < valid_range[0], data > valid_range[1])] = np.nan
-            data = data * slope + intercept
-            return data
-
-    def get_lon_lat(self):
-        lons = self.get_hdf5_data(self.geo_file, 'Geolocation/Longitude')
-        lats = self.get_hdf5_data(self.geo_file, 'Geolocation/Latitude')
-        return lons, lats
-
-    def get_ctop_temperature(self):
-        return self.get_hdf5_data(self.in_file, '5-min granule Cloud Top Temperature', intercept=0)
+    def get_ctop_hight(self, rows=None, step=1):
+        return self.get('ctop_hight', rows=rows, step=step)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+散点密度
+stats.gaussian_kde 在每个点上计算全部点的核函数，O(N²)，几十万个点以上无法使用；
+这里先把点统计到二维网格上，在网格上平滑（高斯滤波或者 FFT 卷积），再用 np.digitize 查找每个点所在网格的密度，O(N)
+
+method:
+    'hist': 二维直方图，sigma 不为 None 时再做高斯平滑
+    'fft': 网格上的高斯核密度估计，核函数和 gaussian_kde 一样（数据协方差，Scott 规则带宽），用 FFT 卷积
+    'kde': stats.gaussian_kde，精确但是 O(N²)，只适合少量的点
+"""
+import numpy as np
+from scipy import stats
+from scipy.ndimage import gaussian_filter
+from scipy.signal import fftconvolve
+
+DENSITY_METHODS = ('hist', 'fft', 'kde')
+
+
+def get_grid_index(x, y, x_edges, y_edges):
+    """
+    每个点所在网格的行列号，超出范围的点放在边缘的网格中
+    """
+    ix = np.clip(np.digitize(x, x_edges) - 1, 0, len(x_edges) - 2)
+    iy = np.clip(np.digitize(y, y_edges) - 1, 0, len(y_edges) - 2)
+    return ix, iy
+
+
+def get_histogram(x, y, bins, x_range=None, y_range=None):
+    """
+    :param bins: 每个方向的网格数，或者 (x 方向网格数, y 方向网格数)
+    :return: (计数 (x 网格数, y 网格数), x 网格边界, y 网格边界)
+    """
+    x_bins, y_bins = (bins, bins) if np.isscalar(bins) else bins
+    if x_range is None:
+        x_range = (np.min(x), np.max(x))
+    if y_range is None:
+        y_range = (np.min(y), np.max(y))
+    if x_range[0] == x_range[1]:
+        x_range = (x_range[0] - 0.5, x_range[1] + 0.5)
+    if y_range[0] == y_range[1]:
+        y_range = (y_range[0] - 0.5, y_range[1] + 0.5)
+    x_edges = np.linspace(x_range[0], x_range[1], x_bins + 1)
+    y_edges = np.linspace(y_range[0], y_range[1], y_bins + 1)
+    # 范围外的点不参与统计，避免堆积在边缘的网格中
+    inside = (x >= x_edges[0]) & (x <= x_edges[-1]) & (y >= y_edges[0]) & (y <= y_edges[-1])
+    ix, iy = get_grid_index(x[inside], y[inside], x_edges, y_edges)
+    counts = np.bincount(ix * y_bins + iy, minlength=x_bins * y_bins).reshape(x_bins, y_bins).astype(np.float64)
+    return counts, x_edges, y_edges
+
+
+def get_bins(count, max_bins):
+    """
+    点数较少时减少网格数，避免网格过细导致密度噪声过大
+    """
+    return int(np.clip(np.sqrt(count), 10, max_bins))
+
+
+def get_density_hist(x, y, bins=None, x_range=None, y_range=None, sigma=1.):
+    """
+    二维直方图密度
+    :param bins: 每个方向的网格数，None 时为 sqrt(点数)，最多 200
+    :param x_range: 网格范围，None 时使用数据的范围
+    :param y_range:
+    :param sigma: 高斯平滑的标准差（网格数），None 时不平滑
+    :return: 每个点的密度（所在网格的点数）
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if bins is None:
+        bins = get_bins(len(x), 200)
+    counts, x_edges, y_edges = get_histogram(x, y, bins, x_range, y_range)
+    if sigma:
+        counts = gaussian_filter(counts, sigma=sigma, mode='constant')
+    ix, iy = get_grid_index(x, y, x_edges, y_edges)
+    return counts[ix, iy]
+
+
+def get_density_fft(x, y, bins=None, x_range=None, y_range=None, bw_factor=None):
+    """
+    网格上的高斯核密度估计
+    :param bins: 每个方向的网格数，None 时为 sqrt(点数)，最多 256
+    :param bw_factor: 带宽系数，None 时使用 Scott 规则 n ** (-1 / 6)
+    :return: 每个点的概率密度
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    count = len(x)
+    if bins is None:
+        bins = get_bins(count, 256)
+    counts, x_edges, y_edges = get_histogram(x, y, bins, x_range, y_range)
+    dx = x_edges[1] - x_edges[0]
+    dy = y_edges[1] - y_edges[0]
+    if bw_factor is None:
+        bw_factor = count ** (-1. / 6)
+    # 和 gaussian_kde 相同的核函数：协方差为数据协方差 * bw_factor²，在网格上离散化
+    # 加上半个网格的方差，x 和 y 完全相关或者没有变化时协方差矩阵也可逆
+    cov = np.cov(x, y) * bw_factor ** 2 + np.diag([(dx / 2) ** 2, (dy / 2) ** 2])
+    half_x = int(min(np.ceil(4 * np.sqrt(cov[0, 0]) / dx), bins))
+    half_y = int(min(np.ceil(4 * np.sqrt(cov[1, 1]) / dy), bins))
+    kx, ky = np.meshgrid(np.arange(-half_x, half_x + 1) * dx, np.arange(-half_y, half_y + 1) * dy, indexing='ij')
+    inv_cov = np.linalg.inv(cov)
+    kernel = np.exp(-0.5 * (inv_cov[0, 0] * kx * kx + 2 * inv_cov[0, 1] * kx * ky + inv_cov[1, 1] * ky * ky))
+    kernel /= kernel.sum()
+    density = fftconvolve(counts, kernel, mode='same')
+    density = np.maximum(density, 0) / (count * dx * dy)
+    ix, iy = get_grid_index(x, y, x_edges, y_edges)
+    return density[ix, iy]
+
+
+def get_density_kde(x, y):
+    pos = np.vstack([x, y])
+    kernel = stats.gaussian_kde(pos)
+    return kernel(pos)
+
+
+def get_density(x, y, method='hist', **kwargs):
+    """
+    :param method: 见 DENSITY_METHODS
+    :param kwargs: 传给对应的方法
+    :return: 每个点的密度，只用于着色，不同方法的量纲不同
+    """
+    if method == 'hist':
+        return get_density_hist(x, y, **kwargs)
+    elif method == 'fft':
+        return get_density_fft(x, y, **kwargs)
+    elif method == 'kde':
+        return get_density_kde(x, y)
+    else:
+        raise ValueError(f'不支持的密度计算方法：{method}，可选：{DENSITY_METHODS}')
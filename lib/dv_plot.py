@@ -8,7 +8,6 @@ from dateutil.relativedelta import relativedelta
 
 import numpy as np
 from numpy.core.multiarray import ndarray
-from scipy import stats
 import matplotlib as mpl
 import matplotlib.image as img
 
@@ -23,6 +22,8 @@ from mpl_toolkits.basemap import Basemap
 import matplotlib.patches as mpatches
 from matplotlib import colorbar
 
+from lib.density import get_density
+
 
 def get_ds_font(font_name="OpenSans-Regular.ttf"):
     """
@@ -182,10 +183,18 @@ class PlotAx(object):
                              color=font_color, font=self.annotate_font)
 
     @classmethod
-    def plot_density_scatter(cls, ax, x, y, marker='o', alpha=1, marker_size=5, zorder=100):
-        pos = np.vstack([x, y])
-        kernel = stats.gaussian_kde(pos)
-        z = kernel(pos)
+    def plot_density_scatter(cls, ax, x, y, marker='o', alpha=1, marker_size=5, zorder=100, density='hist',
+                             x_range=None, y_range=None):
+        """
+        按密度着色的散点图
+        :param density: 密度计算方法，见 lib.density.DENSITY_METHODS
+        :param x_range: 密度网格的范围，None 时使用数据的范围
+        :param y_range:
+        """
+        kwargs = dict()
+        if density != 'kde':
+            kwargs = {'x_range': x_range, 'y_range': y_range}
+        z = get_density(x, y, method=density, **kwargs)
         norm = plt.Normalize()
         norm.autoscale(z)
 
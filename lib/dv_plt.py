@@ -18,7 +18,8 @@ import numpy as np
 from math import ceil
 from datetime import datetime
 from matplotlib.colors import LinearSegmentedColormap
-from scipy import stats
+
+from lib.density import get_density
 
 selfPath = os.path.split(os.path.realpath(__file__))[0]
 RED = '#f63240'
@@ -639,15 +640,17 @@ class dv_scatter(dv_base):
         '''
         画散点
         color = "r"， "g"， "b" 或 "#191e1f" 等时，散点都是一个颜色
-        color = "density" 时，散点按照密度着色
+        color = "density" 时，散点按照密度着色（二维直方图密度）
+        color = "density_fft" 或 "density_kde" 时，使用 FFT 网格核密度估计或者精确的 gaussian_kde
         '''
         norm = None
         cmap = None
         self.leg_len = max(str_len(name), self.leg_len)
         self.set_xminmax(x)
         self.set_yminmax(y)
-        if color == "density":
-            color = self.get_density(x, y)
+        if color in ("density", "density_hist", "density_fft", "density_kde"):
+            method = color[len("density_"):] if "_" in color else "hist"
+            color = self.get_density(x, y, method=method)
             norm = plt.Normalize()
             norm.autoscale(color)
             cmap = self.colormap
@@ -655,13 +658,12 @@ class dv_scatter(dv_base):
                     s=markersize, lw=0, label=name,
                     alpha=alpha)
 
-    def get_density(self, x, y):
+    def get_density(self, x, y, method='hist'):
         '''
         取得密度
+        method 见 lib.density.DENSITY_METHODS，'kde' 为原来的 stats.gaussian_kde
         '''
-        pos = np.vstack([x, y])
-        kernel = stats.gaussian_kde(pos)
-        return kernel(pos)
+        return get_density(x, y, method=method)
 
 
 class dv_bar(dv_base):
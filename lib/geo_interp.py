@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+MODIS 5km 经纬度插值到 1km
+MOD06 的 5km 经纬度每个扫描带 2 行，对应 1km 的 10 行；5km 像元中心位于 1km 扫描带内的第 2、7 行和第 2 + 5 * i 列。
+在单位球的三维坐标上先沿扫描线、再在扫描带内做双线性插值（两端线性外推），
+每个扫描带单独插值，不跨扫描带（蝴蝶结效应），也不受经度 ±180 跳变的影响
+"""
+import numpy as np
+
+from lib.verification import lon_lat_to_xyz
+
+
+def xyz_to_lon_lat(xyz):
+    """
+    三维坐标 -> 经纬度，不要求是单位向量
+    :param xyz: (..., 3)
+    :return: (lons, lats)
+    """
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    lons = np.degrees(np.arctan2(y, x))
+    lats = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return lons.astype(np.float32), lats.astype(np.float32)
+
+
+def get_interp_weights(count, factor, offset, out_count):
+    """
+    低分辨率第 i 个点位于高分辨率的 offset + factor * i，
+    :return: (左侧点 index, 右侧点权重)，超出两端时线性外推
+    """
+    position = np.arange(out_count, dtype=np.float32)
+    index = np.clip((position - offset) // factor, 0, count - 2).astype(np.intp)
+    weight = (position - (offset + factor * index)) / factor
+    return index, weight.astype(np.float32)
+
+
+def interp_5km_to_1km(lons, lats, scan_rows=2, factor=5, row_offset=2, col_offset=2, out_cols=None):
+    """
+    :param lons: 5km 经度 (rows, cols)，rows 是 scan_rows 的整数倍
+    :param lats: 5km 纬度
+    :param scan_rows: 每个扫描带的 5km 行数
+    :param factor: 分辨率倍数
+    :param row_offset: 扫描带内第一行 5km 像元在 1km 中的行号
+    :param col_offset: 第一列 5km 像元在 1km 中的列号
+    :param out_cols: 1km 列数，None 时为 cols * factor + factor - 1（MODIS 270 -> 1354）
+    :return: (lons, lats)，np.float32，(rows * factor, out_cols)
+    """
+    rows, cols = np.shape(lons)
+    if rows % scan_rows != 0:
+        raise ValueError(f'行数 {rows} 不是扫描带行数 {scan_rows} 的整数倍')
+    if out_cols is None:
+        out_cols = cols * factor + factor - 1
+    xyz = lon_lat_to_xyz(lons, lats).astype(np.float32).reshape(rows, cols, 3)
+
+    # 沿扫描线
+    index, weight = get_interp_weights(cols, factor, col_offset, out_cols)
+    weight = weight[None, :, None]
+    xyz = xyz[:, index] * (1 - weight) + xyz[:, index + 1] * weight
+
+    # 扫描带内
+    scans = rows // scan_rows
+    xyz = xyz.reshape(scans, scan_rows, out_cols, 3)
+    index, weight = get_interp_weights(scan_rows, factor, row_offset, scan_rows * factor)
+    weight = weight[None, :, None, None]
+    xyz = xyz[:, index] * (1 - weight) + xyz[:, index + 1] * weight
+
+    return xyz_to_lon_lat(xyz.reshape(rows * factor, out_cols, 3))
@@ -8,6 +8,12 @@ import numpy as np
 from scipy.spatial import cKDTree
 # from pykdtree.kdtree import KDTree  # 使用这个库没有办法保存kdtree
 
+from lib.index_file import is_index_file, write_index_file, read_index_file
+from lib.kdtree_cache import dump_kdtree, load_kdtree
+
+LUT_FORMAT = 'kdtree_lut'
+LUT_VERSION = 1
+
 
 def get_kdtree(lons, lats):
     condition = np.logical_and(np.isfinite(lons), np.isfinite(lats))
@@ -37,9 +43,30 @@ def make_point_index_lut(lons_data, lats_data, out_file):
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    with open(out_file, 'wb') as fp:
-        pickle.dump((idx, ck), fp)
-        print('生成KDtree查找表:{}'.format(out_file))
+    arrays, scalars = dump_kdtree(ck)
+    arrays['row'] = idx[0]
+    arrays['col'] = idx[1]
+    write_index_file(out_file, arrays, scalars, LUT_FORMAT, LUT_VERSION)
+    print('生成KDtree查找表:{}'.format(out_file))
+
+
+def load_point_index_lut(lut_file):
+    """
+    读取 make_point_index_lut 生成的查找表
+    点数据、树的 indices 和行列号是只读 np.memmap，多个进程打开同一个查找表时共享页缓存，不复制；
+    树节点数组在 cKDTree.__setstate__ 中会复制到每个进程自己的内存中（大小约为点数据的 80%）
+    兼容旧版本的 pickle 查找表
+    :param lut_file:
+    :return: (idx, ck)
+    """
+    if not is_index_file(lut_file):
+        print('***WARNING*** 旧版本的 pickle 查找表：{}'.format(lut_file))
+        with open(lut_file, 'rb') as fp:
+            return pickle.load(fp)
+    arrays, scalars = read_index_file(lut_file, LUT_FORMAT, LUT_VERSION)
+    idx = (arrays['row'], arrays['col'])
+    ck = load_kdtree(arrays, scalars)
+    return idx, ck
 
 
 def get_point_index(lon, lat, idx, ck, pre_dist=0.04):
@@ -56,3 +83,29 @@ def get_point_index(lon, lat, idx, ck, pre_dist=0.04):
     else:
         print('***WARNING*** dist > {}, Dont extract.'.format(pre_dist))
         return
+
+
+def get_point_indices(lons, lats, idx, ck, pre_dist=0.04, k=1):
+    """
+    批量获取多个点的最近邻 index，一次 query 完成，使用全部 CPU
+    :param lons: 经度 (N,)
+    :param lats: 纬度 (N,)
+    :param idx: make_point_index_lut 保存的有效数据 index
+    :param ck: cKDTree
+    :param pre_dist: 距离阈值
+    :param k: 每个点取最近的 k 个邻居，窗口提取时使用，例如 3x3 窗口 k=9，5x5 窗口 k=25
+    :return: (rows, cols, valid, dist)，k=1 时 shape 为 (N,)，k>1 时 shape 为 (N, k)，
+             valid 为 False 的位置 rows/cols 为 -1
+    """
+    lons = np.asarray(lons, dtype=np.float64).reshape(-1)
+    lats = np.asarray(lats, dtype=np.float64).reshape(-1)
+    fix_points = np.column_stack((lons, lats))
+    dist, index = ck.query(fix_points, k, distance_upper_bound=pre_dist, workers=-1)
+
+    # 超过距离阈值的点 dist 为 inf，index 为 ck.n
+    valid = dist <= pre_dist
+    index = np.where(valid, index, 0)
+    rows = np.where(valid, idx[0][index], -1)
+    cols = np.where(valid, idx[1][index], -1)
+    print('---INFO---Query points: {}  valid: {}'.format(len(fix_points), valid.sum()))
+    return rows, cols, valid, dist
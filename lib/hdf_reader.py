@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+HDF5 / HDF4 读取
+每个进程对每个文件只保留一个打开的句柄（进程退出或者 close_file 时关闭）；支持按行范围和步长读取；
+有效范围掩码和 slope/intercept 在 float32 上原地一次完成；
+解码后的数组放在按内存大小淘汰的 LRU 缓存中，文件打开期间重复读取时不再解码，close_file 时一起释放
+"""
+import atexit
+import os
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+MAX_OPEN_FILES = 16  # 每个进程最多同时打开的文件数
+MAX_CACHE_SIZE = 256 * 1024 ** 2  # 每个进程解码数据缓存的最大字节数
+
+_files = OrderedDict()  # (pid, 格式, 文件): 文件句柄
+_cache = OrderedDict()  # key: np.ndarray
+_cache_size = 0
+
+
+def _close_handle(file_format, hdf):
+    if file_format == 'hdf5':
+        if hdf.id.valid:
+            hdf.close()
+    else:
+        hdf.end()
+
+
+def _open(file_format, in_file, opener):
+    """
+    获取文件句柄，同一进程内复用；fork 出来的子进程不使用父进程的句柄
+    """
+    key = (os.getpid(), file_format, os.path.abspath(in_file))
+    hdf = _files.get(key)
+    if hdf is not None:
+        _files.move_to_end(key)
+        return hdf
+    hdf = opener(in_file)
+    _files[key] = hdf
+    while len(_files) > MAX_OPEN_FILES:
+        (pid, old_format, _), old = _files.popitem(last=False)
+        if pid == os.getpid():
+            _close_handle(old_format, old)
+    return hdf
+
+
+def open_hdf5(hdf5_file):
+    return _open('hdf5', hdf5_file, lambda f: h5py.File(f, 'r'))
+
+
+def open_hdf4(hdf4_file):
+    from pyhdf.SD import SD, SDC
+    return _open('hdf4', hdf4_file, lambda f: SD(f, SDC.READ))
+
+
+def close_file(in_file):
+    """
+    关闭一个文件的句柄，并从缓存中删除这个文件的解码数据和派生数据（已经返回的数组不受影响）
+    """
+    global _cache_size
+    pid = os.getpid()
+    path = os.path.abspath(in_file)
+    for key in list(_files):
+        file_pid, file_format, file_path = key
+        if file_pid == pid and file_path == path:
+            _close_handle(file_format, _files.pop(key))
+    for key in list(_cache):
+        if key[0] == pid and key[1] == path:
+            _cache_size -= _cache.pop(key).nbytes
+
+
+def close_all():
+    """
+    关闭全部文件句柄，清空缓存
+    """
+    global _cache_size
+    pid = os.getpid()
+    for key in list(_files):
+        hdf = _files.pop(key)
+        if key[0] == pid:
+            _close_handle(key[1], hdf)
+    _cache.clear()
+    _cache_size = 0
+
+
+atexit.register(close_all)
+
+
+def decode(data, slope, intercept, valid_range, fill=np.nan):
+    """
+    转换为 float32 后原地完成有效范围掩码和线性变换
+    :param data: 原始数据
+    :param fill: 超出有效范围的填充值
+    :return: np.float32
+    """
+    data = np.asarray(data)
+    invalid = np.logical_or(data < valid_range[0], data > valid_range[1])
+    data = data.astype(np.float32)
+    slope = np.float32(np.ravel(slope)[0])
+    intercept = np.float32(np.ravel(intercept)[0])
+    if slope != 1:
+        np.multiply(data, slope, out=data)
+    if intercept != 0:
+        np.add(data, intercept, out=data)
+    data[invalid] = fill
+    return data
+
+
+def _cache_put(key, data):
+    global _cache_size
+    data.flags.writeable = False  # 缓存的数组是共享的，不允许修改
+    _cache[key] = data
+    _cache_size += data.nbytes
+    while _cache_size > MAX_CACHE_SIZE and len(_cache) > 1:
+        _, old = _cache.popitem(last=False)
+        _cache_size -= old.nbytes
+
+
+HDF5_ATTRS = {'slope': 'Slope', 'intercept': 'Intercept', 'valid_range': 'valid_range'}
+HDF4_ATTRS = {'slope': 'scale_factor', 'intercept': 'add_offset', 'valid_range': 'valid_range'}
+
+
+def read_hdf5(hdf5_file, data_name, rows, step):
+    """
+    :return: (原始数据, 属性)
+    """
+    dataset = open_hdf5(hdf5_file).get(data_name)
+    if dataset is None:
+        raise KeyError(f'没有数据集：{data_name} {hdf5_file}')
+    selection = (slice(rows[0], rows[1], step),) + (slice(None, None, step),) * (dataset.ndim - 1)
+    return dataset[selection], dataset.attrs
+
+
+def read_hdf4(hdf4_file, data_name, rows, step):
+    """
+    用 SDS.get(start, count, stride) 只读取需要的行，列方向的采样在内存中切片
+    （HDF4 库逐点处理列方向的 stride，比读取整行再切片慢）
+    :return: (原始数据, 属性)
+    """
+    dataset = open_hdf4(hdf4_file).select(data_name)
+    try:
+        attrs = dataset.attributes()
+        dims = dataset.info()[2]
+        if isinstance(dims, int):
+            dims = [dims]
+        row_start, row_stop, _ = slice(rows[0], rows[1]).indices(dims[0])
+        start = [row_start] + [0] * (len(dims) - 1)
+        count = [max(0, -(-(row_stop - row_start) // step))] + list(dims[1:])
+        stride = [step] + [1] * (len(dims) - 1)
+        data = dataset.get(start=start, count=count, stride=stride)
+        if step != 1 and data.ndim > 1:
+            data = data[(slice(None),) + (slice(None, None, step),) * (data.ndim - 1)]
+    finally:
+        dataset.endaccess()
+    return data, attrs
+
+
+READERS = {
+    'hdf5': (read_hdf5, HDF5_ATTRS),
+    'hdf4': (read_hdf4, HDF4_ATTRS),
+}
+
+
+def get_data(file_format, in_file, data_name, slope=None, intercept=None, valid_range=None, fill=np.nan,
+             rows=None, step=1, attrs=None):
+    """
+    读取数据集并解码，所有格式共用同一个解码和缓存流程
+    :param file_format: 'hdf5' 或 'hdf4'
+    :param in_file:
+    :param data_name: 数据集名
+    :param slope: None 时读取属性 attrs['slope']
+    :param intercept: None 时读取属性 attrs['intercept']
+    :param valid_range: None 时读取属性 attrs['valid_range']
+    :param fill: 超出有效范围的填充值
+    :param rows: (start, stop)，只读取这些行
+    :param step: 行列方向的采样步长
+    :param attrs: 属性名，None 时使用这种格式的默认属性名
+    :return: np.float32，只读
+    """
+    reader, default_attrs = READERS[file_format]
+    if attrs is None:
+        attrs = default_attrs
+    if rows is None:
+        rows = (None, None)
+    key = (os.getpid(), os.path.abspath(in_file), os.path.getmtime(in_file), data_name,
+           slope, intercept, None if valid_range is None else tuple(valid_range), fill, tuple(rows), step)
+    data = _cache.get(key)
+    if data is not None:
+        _cache.move_to_end(key)
+        return data
+
+    data, data_attrs = reader(in_file, data_name, rows, step)
+    if slope is None:
+        slope = data_attrs[attrs['slope']]
+    if intercept is None:
+        intercept = data_attrs[attrs['intercept']]
+    if valid_range is None:
+        valid_range = data_attrs[attrs['valid_range']]
+    data = decode(data, slope, intercept, valid_range, fill=fill)
+    _cache_put(key, data)
+    return data
+
+
+def get_derived_data(in_file, data_name, make_data):
+    """
+    由文件中的数据计算得到的数组（比如插值后的经纬度）和解码数据共用同一个缓存，每个 granule 只计算一次
+    :param in_file: 数据来源文件，文件修改后重新计算
+    :param data_name: 派生数据名，不能和数据集名重复
+    :param make_data: 没有命中缓存时调用，返回 np.ndarray
+    :return: np.ndarray，只读
+    """
+    key = (os.getpid(), os.path.abspath(in_file), os.path.getmtime(in_file), data_name)
+    data = _cache.get(key)
+    if data is not None:
+        _cache.move_to_end(key)
+        return data
+    data = make_data()
+    _cache_put(key, data)
+    return data
+
+
+def get_hdf5_data(hdf5_file, data_name, slope=None, intercept=None, valid_range=None, fill=np.nan,
+                  rows=None, step=1):
+    return get_data('hdf5', hdf5_file, data_name, slope, intercept, valid_range, fill=fill, rows=rows, step=step)
+
+
+def get_hdf4_data(hdf4_file, data_name, slope=None, intercept=None, valid_range=None, fill=np.nan,
+                  rows=None, step=1):
+    return get_data('hdf4', hdf4_file, data_name, slope, intercept, valid_range, fill=fill, rows=rows, step=step)
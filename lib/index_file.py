@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+索引文件：JSON 头 + 按 ALIGN 对齐的原始数组块，读取时数组以只读 np.memmap 返回，多个进程共享同一份页缓存
+KDtree 缓存、AERONET 站点缓存和回归统计量的状态文件都使用这个容器，
+每种文件在头中记录自己的格式名和版本，修改一种文件的格式不影响其他文件
+
+文件结构：
+    MAGIC(8字节) + 容器版本(uint32) + 头长度(uint32) + JSON 头 + 按 ALIGN 对齐的原始数组块
+    JSON 头记录格式名、格式版本、标量和每个数组块的 dtype/shape/offset
+"""
+import os
+import json
+import struct
+
+import numpy as np
+
+INDEX_MAGIC = b'IDXFILE\x00'
+CONTAINER_VERSION = 1  # 容器结构的版本，和文件内容的格式版本无关
+ALIGN = 64
+
+
+def get_mtime_ns(in_file):
+    """
+    文件修改时间（整数纳秒），用于判断缓存是否过期；
+    浮点秒写入 csv 再读取后可能和原值不相等，整数可以精确比较
+    """
+    return os.stat(in_file).st_mtime_ns
+
+
+def is_index_file(in_file):
+    with open(in_file, 'rb') as fp:
+        return fp.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def write_index_file(out_file, arrays, scalars, file_format, version):
+    """
+    写索引文件，先写临时文件再改名，避免多个进程同时写入时读到不完整的数据
+    :param out_file:
+    :param arrays: {name: np.ndarray}
+    :param scalars: {name: 可以 JSON 序列化的值}
+    :param file_format: 格式名，比如 'kdtree'
+    :param version: 格式版本
+    """
+    blocks = dict()
+    arrays = {name: np.ascontiguousarray(data) for name, data in arrays.items()}
+    offset = 0
+    for name, data in arrays.items():
+        blocks[name] = {'dtype': data.dtype.str, 'shape': list(data.shape), 'offset': offset}
+        offset += (data.nbytes + ALIGN - 1) // ALIGN * ALIGN
+    header = {'format': file_format, 'version': version, 'scalars': scalars, 'blocks': blocks}
+    header = json.dumps(header).encode()
+    prefix_size = len(INDEX_MAGIC) + 8 + len(header)
+    data_start = (prefix_size + ALIGN - 1) // ALIGN * ALIGN
+    header = header + b' ' * (data_start - prefix_size)
+
+    tmp_file = f'{out_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as fp:
+        fp.write(INDEX_MAGIC)
+        fp.write(struct.pack('<II', CONTAINER_VERSION, len(header)))
+        fp.write(header)
+        for name, data in arrays.items():
+            fp.seek(data_start + blocks[name]['offset'])
+            fp.write(data.tobytes())
+        fp.truncate(data_start + offset)
+    os.replace(tmp_file, out_file)
+
+
+def read_index_file(in_file, file_format, version):
+    """
+    读索引文件，数组全部以只读 np.memmap 返回
+    :param in_file:
+    :param file_format: 期望的格式名，和文件不一致时抛出 ValueError
+    :param version: 期望的格式版本，和文件不一致时抛出 ValueError
+    :return: (arrays, scalars)
+    """
+    with open(in_file, 'rb') as fp:
+        magic = fp.read(len(INDEX_MAGIC))
+        if magic != INDEX_MAGIC:
+            raise ValueError(f'不是索引文件：{in_file}')
+        container_version, header_size = struct.unpack('<II', fp.read(8))
+        if container_version != CONTAINER_VERSION:
+            raise ValueError(f'索引文件版本不支持：{container_version}')
+        header = json.loads(fp.read(header_size).decode())
+    if header.get('format') != file_format or header.get('version') != version:
+        raise ValueError(f'索引文件格式不一致：{header.get("format")} v{header.get("version")}，'
+                         f'需要 {file_format} v{version}')
+    data_start = len(INDEX_MAGIC) + 8 + header_size
+    arrays = dict()
+    for name, block in header['blocks'].items():
+        shape = tuple(block['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=block['dtype'])
+            continue
+        arrays[name] = np.memmap(in_file, dtype=block['dtype'], mode='r',
+                                 offset=data_start + block['offset'], shape=shape)
+    return arrays, header['scalars']
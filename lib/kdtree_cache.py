@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+KDtree 建模结果的磁盘缓存
+以经纬度数据 + 有效数据掩码的内容哈希作为 key，保存 cKDTree 的内部数组和 valid_index1，
+再次遇到相同的经纬度网格时，用 np.memmap 直接映射点数据和 indices，只复制树节点，不需要重新建模
+
+缓存文件是 lib.index_file 的索引文件，格式名 KDTREE_FORMAT
+"""
+import os
+import contextlib
+import hashlib
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from lib.index_file import write_index_file, read_index_file
+
+
+def make_cache_key(lons, lats, valid=None, tag=''):
+    """
+    经纬度内容哈希
+    :param lons: 经度
+    :param lats: 纬度
+    :param valid: 有效数据掩码，None 时不参与哈希
+    :param tag: 建模方式，同一份经纬度用不同的坐标建模时区分缓存
+    :return: str
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(tag.encode())
+    for data in (lons, lats):
+        data = np.ascontiguousarray(data)
+        h.update(str((data.dtype.str, data.shape)).encode())
+        h.update(data.view(np.uint8).reshape(-1))
+    if valid is not None:
+        h.update(np.packbits(valid).tobytes())
+    return h.hexdigest()
+
+
+KDTREE_FORMAT = 'kdtree'
+KDTREE_VERSION = 1
+
+
+def dump_kdtree(kdtree_model):
+    """
+    cKDTree -> (数组字典, 标量字典)
+    """
+    state = kdtree_model.__getstate__()
+    tree, data, n, m, leafsize, maxes, mins, indices, boxsize, boxsize_data = state
+    arrays = {
+        'tree': tree,
+        'data': data,
+        'maxes': maxes,
+        'mins': mins,
+        'indices': indices,
+    }
+    if boxsize is not None:
+        arrays['boxsize'] = boxsize
+        arrays['boxsize_data'] = boxsize_data
+    scalars = {'n': n, 'm': m, 'leafsize': leafsize}
+    return arrays, scalars
+
+
+def load_kdtree(arrays, scalars):
+    """
+    (数组字典, 标量字典) -> cKDTree，data 和 indices 直接引用传入的数组（可以是 memmap），不会复制；
+    树节点数组 tree 由 cKDTree.__setstate__ 复制到当前进程的内存中
+    """
+    state = (arrays['tree'], arrays['data'], scalars['n'], scalars['m'], scalars['leafsize'],
+             arrays['maxes'], arrays['mins'], arrays['indices'],
+             arrays.get('boxsize'), arrays.get('boxsize_data'))
+    kdtree_model = cKDTree.__new__(cKDTree)
+    kdtree_model.__setstate__(state)
+    return kdtree_model
+
+
+class KdtreeCache:
+    """
+    KDtree 磁盘缓存，每个 key 一个索引文件，按目录大小做 LRU 淘汰
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # 缓存目录的最大字节数
+
+        self.hit = 0
+        self.miss = 0
+        self.build_time = 0.
+        self.load_time = 0.
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def __entry_file(self, key):
+        return os.path.join(self.cache_dir, key + '.idx')
+
+    def load(self, key):
+        """
+        读取缓存
+        :param key:
+        :return: (kdtree_model, valid_index) 或者 None
+        """
+        entry_file = self.__entry_file(key)
+        if not os.path.isfile(entry_file):
+            self.miss += 1
+            return
+        t = time.time()
+        try:
+            arrays, scalars = read_index_file(entry_file, KDTREE_FORMAT, KDTREE_VERSION)
+            valid_index = tuple(arrays[f'valid_index_{i}'] for i in range(scalars['valid_ndim']))
+            kdtree_model = load_kdtree(arrays, scalars)
+        except Exception as why:
+            print(f'KDtree缓存读取失败：{entry_file} {why}')
+            with contextlib.suppress(FileNotFoundError):  # 其他进程可能同时淘汰了这个缓存
+                os.remove(entry_file)
+            self.miss += 1
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(entry_file)  # 更新最近使用时间
+        self.hit += 1
+        self.load_time += time.time() - t
+        print(f'KDtree缓存命中：{key}')
+        return kdtree_model, valid_index
+
+    def save(self, key, kdtree_model, valid_index):
+        """
+        写入缓存
+        """
+        entry_file = self.__entry_file(key)
+        if os.path.isfile(entry_file):
+            return
+        arrays, scalars = dump_kdtree(kdtree_model)
+        for i, data in enumerate(valid_index):
+            arrays[f'valid_index_{i}'] = data
+        scalars['valid_ndim'] = len(valid_index)
+        try:
+            write_index_file(entry_file, arrays, scalars, KDTREE_FORMAT, KDTREE_VERSION)
+        except OSError as why:
+            print(f'KDtree缓存写入失败：{entry_file} {why}')
+            return
+        self.evict()
+
+    def get_or_build(self, key, make_x, valid_index):
+        """
+        读取缓存，没有命中时建模并写入缓存
+        :param key: make_cache_key 的结果
+        :param make_x: 返回 (N, 2) 建模数据的函数，只在没有命中时调用
+        :param valid_index: 建模数据在原始数据中的 index
+        :return: (kdtree_model, valid_index)
+        """
+        result = self.load(key)
+        if result is not None:
+            return result
+        t = time.time()
+        kdtree_model = cKDTree(make_x())
+        self.build_time += time.time() - t
+        self.save(key, kdtree_model, valid_index)
+        return kdtree_model, valid_index
+
+    def __entries(self):
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.cache_dir, name)
+            if not name.endswith('.idx'):
+                continue
+            entries.append((os.path.getmtime(entry_file), os.path.getsize(entry_file), entry_file))
+        return entries
+
+    def evict(self):
+        """
+        缓存超过 max_size 时，删除最久没有使用的数据
+        """
+        entries = self.__entries()
+        total_size = sum(e[1] for e in entries)
+        entries.sort()
+        while total_size > self.max_size and len(entries) > 1:
+            _, size, entry_file = entries.pop(0)
+            try:
+                os.remove(entry_file)
+            except OSError:
+                continue
+            total_size -= size
+            print(f'KDtree缓存淘汰：{entry_file}')
+
+    def report(self):
+        print(f'KDtree缓存 命中：{self.hit} 未命中：{self.miss} '
+              f'建模耗时：{self.build_time:.3f}s 读取耗时：{self.load_time:.3f}s')
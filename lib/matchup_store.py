@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+匹配结果的列存储
+按 传感器对/年月 分区，每个 granule 写一个 Parquet 文件（只追加，写临时文件后改名）；
+浮点数保存为 float32，时间保存为 datetime64；
+读取时只读取需要的列和时间范围内的分区，时间条件下推到 Parquet 的行组统计信息
+
+目录结构：
+    store_dir/FY3D_MERSI+AERONET/201902/FY3D_MERSI_AOD_GRANULE_20190228_0000.parquet
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+def to_store_types(data):
+    """
+    :param data: DataFrame 或者 dict
+    :return: DataFrame，浮点数为 float32，时间为 datetime64[ns]，其他 object 为字符串
+    """
+    data = pd.DataFrame(data).reset_index(drop=True)
+    for column in data.columns:
+        values = data[column]
+        if pd.api.types.is_float_dtype(values):
+            data[column] = values.astype(np.float32)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            data[column] = values.astype('datetime64[ns]')
+        elif values.dtype == object:
+            if len(values) > 0 and isinstance(values.iloc[0], (datetime, np.datetime64)):
+                data[column] = pd.to_datetime(values).astype('datetime64[ns]')
+            else:
+                data[column] = values.astype(str)
+    return data
+
+
+class MatchupStore:
+    """
+    一个传感器对的匹配结果
+    """
+
+    def __init__(self, store_dir, pair, compression='zstd'):
+        """
+        :param store_dir: 存储根目录
+        :param pair: 传感器对，比如 'FY3D_MERSI+AERONET'
+        :param compression: Parquet 压缩方式
+        """
+        self.store_dir = store_dir
+        self.pair = pair
+        self.compression = compression
+        self.pair_dir = os.path.join(store_dir, pair)
+
+    def __partition_dir(self, ym):
+        return os.path.join(self.pair_dir, ym)
+
+    def get_file(self, granule, dt):
+        """
+        :param granule: granule 名（不带扩展名）
+        :param dt: granule 时间，决定分区
+        """
+        return os.path.join(self.__partition_dir(f'{dt:%Y%m}'), granule + '.parquet')
+
+    def exists(self, granule, dt):
+        return os.path.isfile(self.get_file(granule, dt))
+
+    def write(self, data, granule, dt):
+        """
+        写入一个 granule 的匹配结果，已经存在时覆盖
+        :param data: DataFrame 或者 dict
+        :param granule: granule 名（不带扩展名）
+        :param dt: granule 时间，决定分区
+        :return: 输出文件
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        out_file = self.get_file(granule, dt)
+        out_dir = os.path.dirname(out_file)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+        table = pa.Table.from_pandas(to_store_types(data), preserve_index=False)
+        tmp_file = f'{out_file}.{os.getpid()}.tmp'
+        pq.write_table(table, tmp_file, compression=self.compression)
+        os.replace(tmp_file, out_file)
+        return out_file
+
+    def get_files(self, dt_s=None, dt_e=None):
+        """
+        :return: 时间范围内的分区中的全部文件
+        """
+        if not os.path.isdir(self.pair_dir):
+            return []
+        yms = sorted(os.listdir(self.pair_dir))
+        if dt_s is not None:
+            yms = [ym for ym in yms if ym >= f'{pd.Timestamp(dt_s):%Y%m}']
+        if dt_e is not None:
+            yms = [ym for ym in yms if ym <= f'{pd.Timestamp(dt_e):%Y%m}']
+        files = list()
+        for ym in yms:
+            partition_dir = self.__partition_dir(ym)
+            files.extend(os.path.join(partition_dir, filename) for filename in sorted(os.listdir(partition_dir))
+                         if filename.endswith('.parquet'))
+        return files
+
+    def read(self, columns=None, dt_s=None, dt_e=None, dt_column='dt_s1'):
+        """
+        读取匹配结果
+        :param columns: 只读取这些列，None 时读取全部列
+        :param dt_s: dt_column >= dt_s，None 时不限制
+        :param dt_e: dt_column < dt_e，None 时不限制
+        :param dt_column: 时间条件使用的列
+        :return: DataFrame，没有数据时为空 DataFrame
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        files = self.get_files(dt_s, dt_e)
+        if not files:
+            return pd.DataFrame(columns=columns)
+        dataset = ds.dataset(files, format='parquet')
+        conditions = list()
+        if dt_s is not None:
+            conditions.append(ds.field(dt_column) >= pa.scalar(pd.Timestamp(dt_s), type=pa.timestamp('ns')))
+        if dt_e is not None:
+            conditions.append(ds.field(dt_column) < pa.scalar(pd.Timestamp(dt_e), type=pa.timestamp('ns')))
+        condition = None
+        for expression in conditions:
+            condition = expression if condition is None else condition & expression
+        table = dataset.to_table(columns=columns, filter=condition)
+        return table.to_pandas()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+两个传感器 granule 的时空匹配
+每个文件名只解析一次时间，按时间排序后用 searchsorted 做区间连接，找到 ±window 内的全部 granule 对；
+可选地再用缓存的 granule 经纬度范围（footprint）剔除没有空间重叠的 granule 对
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from lib.index_file import get_mtime_ns
+from lib.verification import get_valid_lon_lat_mask, get_lon_span
+
+
+def get_granule_times(filenames, get_datetime):
+    """
+    :param filenames: 文件名或者文件路径
+    :param get_datetime: 文件名 -> datetime
+    :return: (按时间排序的 np.datetime64[s], 对应的文件)，无法解析时间的文件跳过
+    """
+    dts = list()
+    files = list()
+    for in_file in filenames:
+        try:
+            dt = get_datetime(os.path.basename(in_file))
+        except (ValueError, IndexError):
+            print(f'***WARNING*** 无法从文件名获取时间：{in_file}')
+            continue
+        dts.append(dt)
+        files.append(in_file)
+    dts = np.array(dts, dtype='datetime64[s]')
+    files = np.array(files, dtype=object)
+    order = np.argsort(dts, kind='stable')
+    return dts[order], files[order]
+
+
+def pair_by_time(dts1, dts2, window):
+    """
+    区间连接：dts1 中的每个时间和 dts2 中 [dt - window, dt + window] 内的全部时间配对
+    :param dts1: np.datetime64
+    :param dts2: 排序后的 np.datetime64
+    :param window: np.timedelta64 或者 datetime.timedelta
+    :return: (index1, index2)
+    """
+    window = np.timedelta64(window)
+    lo = np.searchsorted(dts2, dts1 - window, side='left')
+    hi = np.searchsorted(dts2, dts1 + window, side='right')
+    counts = hi - lo
+    index1 = np.repeat(np.arange(len(dts1)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    index2 = np.arange(counts.sum()) - starts + np.repeat(lo, counts)
+    return index1, index2
+
+
+def footprints_overlap(footprints1, footprints2, margin=0.):
+    """
+    :param footprints1: (N, 4)，每行 (lon_min, lon_max, lat_min, lat_max)，经度范围是 get_lon_span 的结果
+    :param footprints2: (N, 4)
+    :param margin: 范围向外扩展的距离(度)
+    :return: (N,) bool，footprint 为 nan 时为 False
+    """
+    lon_min1, lon_max1, lat_min1, lat_max1 = np.asarray(footprints1, dtype=np.float64).T
+    lon_min2, lon_max2, lat_min2, lat_max2 = np.asarray(footprints2, dtype=np.float64).T
+    overlap = (lat_min1 - margin <= lat_max2 + margin) & (lat_min2 - margin <= lat_max1 + margin)
+    lon_overlap = np.zeros_like(overlap)
+    for offset in (-360, 0, 360):
+        lon_overlap |= (lon_min1 - margin <= lon_max2 + offset + margin) & \
+                       (lon_min2 + offset - margin <= lon_max1 + margin)
+    return overlap & lon_overlap
+
+
+class FootprintCache:
+    """
+    granule 经纬度范围的缓存，保存到 cache_file（csv），只重新计算新增或者 mtime 变化的文件
+    """
+    columns = ['file', 'mtime', 'lon_min', 'lon_max', 'lat_min', 'lat_max']
+
+    def __init__(self, get_lon_lat, cache_file=None):
+        """
+        :param get_lon_lat: 文件 -> (lons, lats)
+        :param cache_file: None 时只缓存在内存中
+        """
+        self.get_lon_lat = get_lon_lat
+        self.cache_file = cache_file
+        self.footprints = dict()
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            cache = pd.read_csv(self.cache_file, index_col=False)
+            for record in cache[self.columns].itertuples(index=False):
+                self.footprints[record[0]] = tuple(record[1:])
+        self.changed = 0
+
+    def get_footprint(self, in_file):
+        """
+        :return: (lon_min, lon_max, lat_min, lat_max)，没有有效经纬度或者读取失败时全部为 nan
+        """
+        mtime = get_mtime_ns(in_file)
+        footprint = self.footprints.get(in_file)
+        if footprint is not None and footprint[0] == mtime:
+            return footprint[1:]
+        footprint = (np.nan,) * 4
+        try:
+            lons, lats = self.get_lon_lat(in_file)
+            valid = get_valid_lon_lat_mask(lons, lats)
+            if valid.any():
+                lons, lats = lons[valid], lats[valid]
+                footprint = (*get_lon_span(lons), lats.min(), lats.max())
+        except Exception as why:
+            print(f'获取经纬度范围失败：{in_file} {why}')
+        self.footprints[in_file] = (mtime, *(float(i) for i in footprint))
+        self.changed += 1
+        return self.footprints[in_file][1:]
+
+    def get_footprints(self, files):
+        """
+        :return: (N, 4)
+        """
+        return np.array([self.get_footprint(in_file) for in_file in files], dtype=np.float64).reshape(-1, 4)
+
+    def save(self):
+        if self.cache_file is None or self.changed == 0:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        records = [(in_file, *footprint) for in_file, footprint in self.footprints.items()]
+        pd.DataFrame(records, columns=self.columns).to_csv(self.cache_file, index=False)
+        self.changed = 0
+        print('>>> {}'.format(self.cache_file))
+
+
+def pair_granules(files1, files2, get_datetime1, get_datetime2, window, footprint_cache1=None,
+                  footprint_cache2=None, margin=0.):
+    """
+    :param files1: 传感器 1 的文件
+    :param files2: 传感器 2 的文件
+    :param get_datetime1: 文件名 -> datetime
+    :param get_datetime2: 文件名 -> datetime
+    :param window: 时间窗口，np.timedelta64 或者 datetime.timedelta
+    :param footprint_cache1: FootprintCache，两个都不是 None 时要求经纬度范围重叠
+    :param footprint_cache2: FootprintCache
+    :param margin: 经纬度范围向外扩展的距离(度)
+    :return: [(file1, dt1, file2, dt2)]，按 (dt1, dt2) 排序
+    """
+    dts1, files1 = get_granule_times(files1, get_datetime1)
+    dts2, files2 = get_granule_times(files2, get_datetime2)
+    index1, index2 = pair_by_time(dts1, dts2, window)
+    print(f'时间匹配：{len(files1)} x {len(files2)} 个 granule，{len(index1)} 对')
+
+    if footprint_cache1 is not None and footprint_cache2 is not None and len(index1) > 0:
+        used1, inverse1 = np.unique(index1, return_inverse=True)
+        used2, inverse2 = np.unique(index2, return_inverse=True)
+        footprints1 = footprint_cache1.get_footprints(files1[used1])[inverse1]
+        footprints2 = footprint_cache2.get_footprints(files2[used2])[inverse2]
+        overlap = footprints_overlap(footprints1, footprints2, margin)
+        index1, index2 = index1[overlap], index2[overlap]
+        footprint_cache1.save()
+        footprint_cache2.save()
+        print(f'空间匹配：{len(index1)} 对')
+
+    return [(files1[i1], dts1[i1].item(), files2[i2], dts2[i2].item()) for i1, i2 in zip(index1, index2)]
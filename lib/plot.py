@@ -55,7 +55,16 @@ def plot_regression(
         ymd_start=None,
         ymd_end=None,
         ymd=None,
-        density=False, ):
+        density=False,
+        mode='scatter',
+        bin_size=None, ):
+    """
+    :param density: False 时散点为单一颜色；True 或者 'hist' 时按二维直方图密度着色，
+        'fft' 为 FFT 网格核密度估计，'kde' 为 stats.gaussian_kde（O(N²)，只适合少量的点）
+    :param mode: 'scatter' 画每个点；'hist2d' 画 x_range/y_range 内每个网格的点数（对数色标），
+        绘图时间和输出文件大小与点数无关，适合大量的点，这时忽略 density
+    :param bin_size: mode='hist2d' 时的网格大小，一个数或者 (x 方向, y 方向)，None 时每个方向 200 个网格
+    """
     # style_file = os.path.join('plot_regression.mplstyle')
     # plt.style.use(style_file)
     figsize = (5, 5)
@@ -67,12 +76,20 @@ def plot_regression(
 
     # ##### 画散点
     marker_size = 5
-    if density:
+    if mode == 'hist2d':
+        zorder = 60  # 图像覆盖整个区域，放在回归线和对角线下面
+        image = plot_ax.plot_hist2d(ax1, x, y, x_range=x_range, y_range=y_range, bin_size=bin_size,
+                                    zorder=zorder)
+        colorbar = fig.colorbar(image, ax=ax1, fraction=0.046, pad=0.02)
+        colorbar.set_label('Count', fontproperties=LABEL_FONT)
+    elif density:
         marker = 'o'
         alpha = 0.8
         zorder = 90
+        if density is True:
+            density = 'hist'
         plot_ax.plot_density_scatter(ax1, x, y, marker=marker, alpha=alpha, marker_size=marker_size,
-                                     zorder=zorder)
+                                     zorder=zorder, density=density, x_range=x_range, y_range=y_range)
     else:
         alpha = 0.8  # 透明度
         marker = "o"  # 形状
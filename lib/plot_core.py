@@ -7,7 +7,6 @@ import os
 from dateutil.relativedelta import relativedelta
 
 import numpy as np
-from scipy import stats
 import matplotlib as mpl
 import matplotlib.image as img
 
@@ -20,6 +19,8 @@ from matplotlib.font_manager import FontProperties
 from matplotlib import colors
 from matplotlib import colorbar
 
+from lib.density import get_density, get_histogram
+
 
 def get_ds_font(font_name="OpenSans-Regular.ttf"):
     """
@@ -179,10 +180,18 @@ class PlotAx(object):
                              color=font_color, font=self.annotate_font)
 
     @classmethod
-    def plot_density_scatter(cls, ax, x, y, marker='o', alpha=1, marker_size=5, zorder=100):
-        pos = np.vstack([x, y])
-        kernel = stats.gaussian_kde(pos)
-        z = kernel(pos)
+    def plot_density_scatter(cls, ax, x, y, marker='o', alpha=1, marker_size=5, zorder=100, density='hist',
+                             x_range=None, y_range=None):
+        """
+        按密度着色的散点图
+        :param density: 密度计算方法，见 lib.density.DENSITY_METHODS
+        :param x_range: 密度网格的范围，None 时使用数据的范围
+        :param y_range:
+        """
+        kwargs = dict()
+        if density != 'kde':
+            kwargs = {'x_range': x_range, 'y_range': y_range}
+        z = get_density(x, y, method=density, **kwargs)
         norm = plt.Normalize()
         norm.autoscale(z)
 
@@ -190,6 +199,34 @@ class PlotAx(object):
                    cmap=plt.get_cmap('jet'), lw=0,
                    alpha=alpha, zorder=zorder)
 
+    @classmethod
+    def plot_hist2d(cls, ax, x, y, x_range=None, y_range=None, bin_size=None, bins=200, cmap='jet', alpha=1,
+                    zorder=100):
+        """
+        把散点统计到二维网格上，用一个图像画出每个网格的点数（对数色标），绘图时间和点数无关
+        :param x_range: 网格范围，None 时使用数据的范围
+        :param y_range:
+        :param bin_size: 网格大小，一个数或者 (x 方向, y 方向)，None 时每个方向 bins 个网格
+        :param bins: bin_size 为 None 时每个方向的网格数
+        :return: AxesImage
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if x_range is None:
+            x_range = (np.nanmin(x), np.nanmax(x))
+        if y_range is None:
+            y_range = (np.nanmin(y), np.nanmax(y))
+        if bin_size is not None:
+            x_size, y_size = (bin_size, bin_size) if np.isscalar(bin_size) else bin_size
+            bins = (max(int(round((x_range[1] - x_range[0]) / x_size)), 1),
+                    max(int(round((y_range[1] - y_range[0]) / y_size)), 1))
+        counts, x_edges, y_edges = get_histogram(x, y, bins, x_range, y_range)
+        counts = np.ma.masked_equal(counts.T, 0)
+        vmax = max(counts.max(), 1) if counts.count() > 0 else 1
+        return ax.imshow(counts, origin='lower', extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                         aspect='auto', interpolation='nearest', cmap=plt.get_cmap(cmap),
+                         norm=colors.LogNorm(vmin=1, vmax=vmax), alpha=alpha, zorder=zorder)
+
     @classmethod
     def plot_regression_line(cls, ax, x, y, w, x_range=None, color='r', linewidth=1.2, zorder=100):
         ab = np.polyfit(x, y, 1, w=w)
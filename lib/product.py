@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+产品读取注册表
+每个产品只声明文件格式、数据集（所在文件、数据集名、slope/intercept/valid_range 的来源）和文件名中的时间，
+读取统一使用 lib.hdf_reader：float32、原地解码、无效值为 nan、解码结果缓存
+
+增加产品：
+    register_product('NAME', file_format='hdf5', datasets={...}, get_datetime=...)
+    class Name(ProductReader):
+        product = 'NAME'
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+
+from lib import hdf_reader
+
+PRODUCTS = dict()
+
+
+def register_product(name, file_format, datasets, get_datetime=None, attrs=None):
+    """
+    :param name: 产品名
+    :param file_format: 'hdf5' 或 'hdf4'
+    :param datasets: {数据名: dict(file='in' 或 'geo', name=数据集名, slope=None, intercept=None, valid_range=None)}
+        slope/intercept/valid_range 为 None 时从数据集属性中读取
+    :param get_datetime: 文件名 -> datetime
+    :param attrs: 属性名，None 时使用这种格式的默认属性名
+    """
+    PRODUCTS[name] = {
+        'file_format': file_format,
+        'datasets': datasets,
+        'get_datetime': get_datetime,
+        'attrs': attrs,
+    }
+
+
+class ProductReader:
+    product = None
+
+    def __init__(self, in_file, geo_file=None):
+        self.in_file = in_file
+        self.geo_file = geo_file
+        self.filename = os.path.basename(in_file)
+        self.spec = PRODUCTS[self.product]
+        self.dt = None
+        if self.spec['get_datetime'] is not None:
+            try:
+                self.dt = self.spec['get_datetime'](self.filename)
+            except ValueError:
+                print(f'***WARNING*** 无法从文件名获取时间：{self.filename}')
+
+    def get(self, data_name, rows=None, step=1, **kwargs):
+        """
+        读取注册的数据
+        :param data_name: 注册时的数据名
+        :param rows: (start, stop)，只读取这些行
+        :param step: 行列方向的采样步长
+        :param kwargs: 覆盖注册的 slope/intercept/valid_range
+        :return: np.float32，只读
+        """
+        dataset = dict(self.spec['datasets'][data_name])
+        dataset.update(kwargs)
+        in_file = self.geo_file if dataset.get('file') == 'geo' else self.in_file
+        return hdf_reader.get_data(
+            self.spec['file_format'], in_file, dataset['name'],
+            slope=dataset.get('slope'), intercept=dataset.get('intercept'), valid_range=dataset.get('valid_range'),
+            fill=np.nan, rows=rows, step=step, attrs=self.spec['attrs'])
+
+    def get_lon_lat(self, rows=None, step=1):
+        return self.get('lon', rows=rows, step=step), self.get('lat', rows=rows, step=step)
+
+    def close(self):
+        """
+        关闭文件句柄，释放这两个文件的解码缓存
+        """
+        for in_file in (self.in_file, self.geo_file):
+            if in_file is not None:
+                hdf_reader.close_file(in_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def fy3d_mersi_aod_datetime(filename):
+    """
+    FY3D_MERSI_AOD_GRANULE_20190228_0000.HDF5
+    """
+    ymdhm = "".join(os.path.splitext(filename)[0].split('_')[4:6])
+    return datetime.strptime(ymdhm, '%Y%m%d%H%M')
+
+
+def fy3c_virr_cpp_datetime(filename):
+    """
+    FY3C_VIRRD_ORBT_L2_CPP_MLT_NUL_20200104_0000_1000M_MS.HDF
+    """
+    ymdhm = "".join(filename.split('_')[7:9])
+    return datetime.strptime(ymdhm, '%Y%m%d%H%M')
+
+
+def modis_mod06_datetime(filename):
+    """
+    MOD06_L2.A2020004.0755.061.2020004193547.hdf
+    """
+    yjhm = "".join(filename.split('.')[1:3])
+    return datetime.strptime(yjhm, 'A%Y%j%H%M')
+
+
+register_product(
+    'FY3D_MERSI_AOD', 'hdf5',
+    datasets={
+        'lon': dict(file='geo', name='Longitude', slope=1, intercept=0, valid_range=(-180, 180)),
+        'lat': dict(file='geo', name='Latitude', slope=1, intercept=0, valid_range=(-90, 90)),
+        'aod': dict(file='in', name='Optical_Depth_Land_And_Ocean', slope=1, intercept=0, valid_range=(0, 1000)),
+    },
+    get_datetime=fy3d_mersi_aod_datetime,
+)
+
+register_product(
+    'FY3C_VIRR_CPP', 'hdf5',
+    datasets={
+        'lon': dict(file='geo', name='Geolocation/Longitude'),
+        'lat': dict(file='geo', name='Geolocation/Latitude'),
+        'ctop_temperature': dict(file='in', name='5-min granule Cloud Top Temperature', intercept=0),
+        'ctop_hight': dict(file='in', name='5-min granule Cloud Top Height'),
+    },
+    get_datetime=fy3c_virr_cpp_datetime,
+)
+
+register_product(
+    'MODIS_MOD06', 'hdf4',
+    datasets={
+        'lon': dict(file='in', name='Longitude'),
+        'lat': dict(file='in', name='Latitude'),
+        'ctop_temperature': dict(file='in', name='Cloud_Top_Temperature', intercept=0),
+        'ctop_hight': dict(file='in', name='Cloud_Top_Height'),
+        'ctop_temperature_1km': dict(file='in', name='cloud_top_temperature_1km', intercept=0),
+        'ctop_hight_1km': dict(file='in', name='cloud_top_height_1km'),
+    },
+    get_datetime=modis_mod06_datetime,
+)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Author  : NingAnMe <ninganme@qq.com>
+"""
+增量回归统计
+按 (日期, 站点) 保存回归的充分统计量 n, Σx, Σy, Σxy, Σx², Σy², Σ(x-y), Σ(x-y)²，
+每个 granule 的匹配结果产生后累加一次，任意时间段、站点的回归系数、偏差和均方根误差都由这些和直接计算，
+不需要重新读取匹配结果
+
+状态文件使用 lib.index_file 的索引文件：日期、站点编号、统计量和已经累加的 granule 名（排序后的 ASCII 字节串数组）+ JSON 头中的站点名；
+granule 名不放在 JSON 头中，数量增长后读取时也不需要解析，按二分查找判断是否已经累加
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from lib.index_file import write_index_file, read_index_file
+
+STATS_FORMAT = 'regression_stats'
+STATS_VERSION = 2  # 2: granule 名保存为数组块
+STATS_COLUMNS = ['n', 'sx', 'sy', 'sxy', 'sxx', 'syy', 'sd', 'sdd']
+
+
+def get_sums(x, y, dts, sites):
+    """
+    一组匹配数据的充分统计量，只使用 x > 0 且 y > 0 的数据
+    :param x: 卫星数据
+    :param y: 地面数据
+    :param dts: 卫星观测时间，和 x 等长或者是一个时间
+    :param sites: 站点名，和 x 等长或者是一个站点名
+    :return: DataFrame，index 为 (date, site)，列为 STATS_COLUMNS
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    dates = np.broadcast_to(np.asarray(dts, dtype='datetime64[D]'), x.shape)
+    sites = np.broadcast_to(np.asarray(sites, dtype=str), x.shape)
+    index = (x > 0) & (y > 0)
+    x, y, dates, sites = x[index], y[index], dates[index], sites[index]
+    d = x - y
+    data = pd.DataFrame({
+        'date': dates, 'site': sites,
+        'n': np.ones_like(x), 'sx': x, 'sy': y, 'sxy': x * y, 'sxx': x * x, 'syy': y * y, 'sd': d, 'sdd': d * d,
+    })
+    return data.groupby(['date', 'site']).sum()
+
+
+def get_coefficients(sums):
+    """
+    :param sums: 统计量的和，Series 或者 DataFrame（每行一组）
+    :return: slope, intercept, r, bias(x - y 的均值), rmse, n
+    """
+    n = sums['n']
+    sxx = sums['sxx'] - sums['sx'] ** 2 / n
+    syy = sums['syy'] - sums['sy'] ** 2 / n
+    sxy = sums['sxy'] - sums['sx'] * sums['sy'] / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        intercept = (sums['sy'] - slope * sums['sx']) / n
+        r = sxy / np.sqrt(sxx * syy)
+        bias = sums['sd'] / n
+        rmse = np.sqrt(sums['sdd'] / n)
+    coefficients = {'slope': slope, 'intercept': intercept, 'r': r, 'bias': bias, 'rmse': rmse, 'n': n}
+    if isinstance(sums, pd.DataFrame):
+        return pd.DataFrame(coefficients)
+    return coefficients
+
+
+class RegressionStats:
+    """
+    按 (日期, 站点) 累加的回归统计量
+    """
+
+    def __init__(self, state_file=None):
+        """
+        :param state_file: 状态文件，None 时只保存在内存中
+        """
+        self.state_file = state_file
+        self.sums = pd.DataFrame(columns=STATS_COLUMNS, dtype=np.float64,
+                                 index=pd.MultiIndex.from_arrays([[], []], names=['date', 'site']))
+        self.saved_granules = np.array([], dtype='S1')  # 状态文件中的 granule，排序后的只读字节串数组
+        self.new_granules = set()  # 读取状态文件之后累加的 granule
+        if self.state_file is not None and os.path.isfile(self.state_file):
+            self.load()
+
+    def load(self):
+        arrays, scalars = read_index_file(self.state_file, STATS_FORMAT, STATS_VERSION)
+        sites = np.array(scalars['sites'], dtype=object)
+        index = pd.MultiIndex.from_arrays(
+            [np.asarray(arrays['dates']).astype('datetime64[D]'), sites[np.asarray(arrays['sites'])]],
+            names=['date', 'site'])
+        self.sums = pd.DataFrame(np.array(arrays['sums']), index=index, columns=STATS_COLUMNS)
+        self.saved_granules = arrays['granules']
+
+    def save(self):
+        if self.state_file is None:
+            return
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        sites, site_index = np.unique(self.sums.index.get_level_values('site').to_numpy(dtype=str),
+                                      return_inverse=True)
+        dates = self.sums.index.get_level_values('date').to_numpy(dtype='datetime64[D]')
+        arrays = {
+            'dates': dates.astype(np.int64),
+            'sites': site_index.astype(np.int32),
+            'sums': self.sums[STATS_COLUMNS].to_numpy(dtype=np.float64),
+            'granules': np.union1d(self.saved_granules, np.array(sorted(self.new_granules), dtype='S')),
+        }
+        scalars = {'sites': sites.tolist()}
+        write_index_file(self.state_file, arrays, scalars, STATS_FORMAT, STATS_VERSION)
+        self.saved_granules = arrays['granules']
+        self.new_granules = set()
+
+    def has_granule(self, granule):
+        """
+        granule 是否已经累加
+        """
+        if granule in self.new_granules:
+            return True
+        granule = granule.encode()
+        index = np.searchsorted(self.saved_granules, granule)
+        return bool(index < len(self.saved_granules) and self.saved_granules[index] == granule)
+
+    def granule_count(self):
+        return len(self.saved_granules) + len(self.new_granules)
+
+    def merge(self, sums, granule=None):
+        """
+        累加一个 granule 的统计量（get_sums 的结果），同一个 granule 只累加一次
+        :return: 是否累加
+        """
+        if granule is not None:
+            if self.has_granule(granule):
+                return False
+            self.new_granules.add(granule)
+        if len(sums) > 0:
+            self.sums = self.sums.add(sums[STATS_COLUMNS], fill_value=0).sort_index()
+        return True
+
+    def update(self, x, y, dts, sites, granule=None):
+        """
+        累加一组匹配数据
+        """
+        return self.merge(get_sums(x, y, dts, sites), granule)
+
+    def select(self, dt_s=None, dt_e=None, site=None):
+        """
+        :param dt_s: date >= dt_s
+        :param dt_e: date < dt_e
+        :param site: 站点名，None 时为全部站点
+        :return: DataFrame，选中的 (日期, 站点) 的统计量
+        """
+        sums = self.sums
+        dates = sums.index.get_level_values('date')
+        index = np.ones(len(sums), dtype=bool)
+        if dt_s is not None:
+            index &= dates >= pd.Timestamp(dt_s)
+        if dt_e is not None:
+            index &= dates < pd.Timestamp(dt_e)
+        if site is not None:
+            index &= sums.index.get_level_values('site') == site
+        return sums[index]
+
+    def get_coefficients(self, dt_s=None, dt_e=None, site=None):
+        """
+        一个时间段（和站点）的回归系数
+        :return: dict，见 get_coefficients
+        """
+        return get_coefficients(self.select(dt_s, dt_e, site).sum())
+
+    def get_period_coefficients(self, freq='D', by_site=False):
+        """
+        每天 / 每月 / 每年的回归系数
+        :param freq: 'D', 'M' 或者 'Y'
+        :param by_site: 同时按站点分组
+        :return: DataFrame
+        """
+        sums = self.sums.reset_index()
+        period = pd.DatetimeIndex(sums['date']).to_period(freq)
+        keys = [period.rename('period')]
+        if by_site:
+            keys.append(sums['site'])
+        return get_coefficients(sums[STATS_COLUMNS].groupby(keys).sum())
@@ -2,23 +2,190 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2020-07-27 11:06
 # @Author  : NingAnMe <ninganme@qq.com>
+import time
+import warnings
+
 import numpy as np
 from scipy.spatial import cKDTree
 
+from lib.kdtree_cache import make_cache_key
+
+
+EARTH_RADIUS = 6371.0088  # 地球平均半径(km)
+
+
+def lon_lat_to_xyz(lons, lats):
+    """
+    经纬度转单位球上的三维坐标
+    三角函数在 float32 上计算，直接写入 cKDTree 使用的 float64 (N, 3) 数组，不产生中间拷贝
+    :return: (N, 3)
+    """
+    lons = np.radians(np.asarray(lons, dtype=np.float32).reshape(-1))
+    lats = np.radians(np.asarray(lats, dtype=np.float32).reshape(-1))
+    x = np.empty((len(lons), 3), dtype=np.float64)
+    cos_lats = np.cos(lats)
+    np.multiply(cos_lats, np.cos(lons), out=x[:, 0])
+    np.multiply(cos_lats, np.sin(lons), out=x[:, 1])
+    np.sin(lats, out=x[:, 2])
+    return x
+
+
+def km_to_chord(dist):
+    """
+    球面距离(km) -> 单位球上的弦长
+    """
+    return 2 * np.sin(np.asarray(dist) / (2 * EARTH_RADIUS))
+
+
+def chord_to_km(chord):
+    """
+    单位球上的弦长 -> 球面距离(km)，inf 保持为 inf
+    """
+    chord = np.asarray(chord, dtype=np.float64)
+    dist = np.full(chord.shape, np.inf)
+    finite = np.isfinite(chord)
+    dist[finite] = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord[finite] / 2, 1))
+    return dist
+
+
+def get_lon_lat_box(lons, lats, margin=0.):
+    """
+    获取有效经纬度的范围
+    :param margin: 范围向外扩展的距离(度)
+    :return: (lon_min, lon_max, lat_min, lat_max)，没有有效数据时返回 None
+    """
+    valid = get_valid_lon_lat_mask(lons, lats)
+    if not valid.any():
+        return
+    lons = lons[valid]
+    lats = lats[valid]
+    return lons.min() - margin, lons.max() + margin, lats.min() - margin, lats.max() + margin
+
+
+def get_valid_lon_lat_mask(lons, lats):
+    return np.isfinite(lons) & np.isfinite(lats) & (np.abs(lons) <= 180) & (np.abs(lats) <= 90)
+
+
+def get_lon_span(lons, margin=0.):
+    """
+    获取连续的经度范围，考虑跨 180 度经线的情况：分别在 [-180, 180] 和 [0, 360] 中计算范围，取较小的一个
+    :param lons: 有效经度
+    :param margin: 范围向外扩展的距离(度)
+    :return: (lon_min, lon_max)，跨 180 度经线时 lon_min < -180
+    """
+    lons_360 = np.where(lons < 0, lons + 360, lons)
+    lon_min, lon_max = lons.min() - margin, lons.max() + margin
+    lon_min_360, lon_max_360 = lons_360.min() - margin, lons_360.max() + margin
+    if lon_max_360 - lon_min_360 < lon_max - lon_min:
+        lon_min, lon_max = lon_min_360 - 360, lon_max_360 - 360
+    return lon_min, lon_max
+
+
+def get_lon_ranges(lons, margin=0.):
+    """
+    获取经度范围，跨 180 度经线时拆分为两段
+    :param lons: 有效经度
+    :param margin: 范围向外扩展的距离(度)
+    :return: [(lon_min, lon_max)]
+    """
+    lon_min, lon_max = get_lon_span(lons, margin)
+    if lon_max - lon_min >= 360:
+        return [(-180., 180.)]
+    ranges = list()
+    for offset in (-360, 0, 360):
+        lo = max(lon_min + offset, -180.)
+        hi = min(lon_max + offset, 180.)
+        if lo <= hi:
+            ranges.append((lo, hi))
+    return ranges
+
+
+def get_overlap(lons1, lats1, lons2, lats2, margin=0.):
+    """
+    两组数据经纬度范围的重叠区域，每组的范围都向外扩展 margin
+    :return: (经度范围列表, (lat_min, lat_max))，没有重叠时返回 None
+    """
+    valid1 = get_valid_lon_lat_mask(lons1, lats1)
+    valid2 = get_valid_lon_lat_mask(lons2, lats2)
+    if not valid1.any() or not valid2.any():
+        return
+    lat_min = max(lats1[valid1].min(), lats2[valid2].min()) - margin
+    lat_max = min(lats1[valid1].max(), lats2[valid2].max()) + margin
+    if lat_min > lat_max:
+        return
+    lon_ranges = list()
+    for lo1, hi1 in get_lon_ranges(lons1[valid1], margin):
+        for lo2, hi2 in get_lon_ranges(lons2[valid2], margin):
+            lo, hi = max(lo1, lo2), min(hi1, hi2)
+            if lo <= hi:
+                lon_ranges.append((lo, hi))
+    if not lon_ranges:
+        return
+    return lon_ranges, (lat_min, lat_max)
+
+
+def clip_to_overlap(lons, lats, overlap, *datas):
+    """
+    裁剪到重叠区域：先按行列裁剪出包含重叠区域的最小矩形，矩形内不在重叠区域的经纬度设为 nan
+    :param lons: 经度，1 维或 2 维
+    :param lats: 纬度
+    :param overlap: get_overlap 的结果
+    :param datas: 与经纬度 shape 相同的数据，只按行列裁剪
+    :return: (lons, lats, *datas)，没有重叠区域内的数据时返回 None
+    """
+    lon_ranges, (lat_min, lat_max) = overlap
+    valid = get_valid_lon_lat_mask(lons, lats)
+    mask = valid & (lats >= lat_min) & (lats <= lat_max)
+    in_lon = np.zeros_like(mask)
+    for lo, hi in lon_ranges:
+        in_lon |= (lons >= lo) & (lons <= hi)
+    mask &= in_lon
+
+    valid_count = valid.sum()
+    overlap_count = mask.sum()
+    print(f'重叠区域裁剪：有效数据 {valid_count} 保留 {overlap_count} 剔除 {valid_count - overlap_count}')
+    if overlap_count == 0:
+        return
+
+    slices = list()
+    for axis in range(mask.ndim):
+        other_axis = tuple(i for i in range(mask.ndim) if i != axis)
+        index = np.flatnonzero(mask.any(axis=other_axis)) if other_axis else np.flatnonzero(mask)
+        slices.append(slice(index[0], index[-1] + 1))
+    slices = tuple(slices)
+
+    mask = mask[slices]
+    lons = np.where(mask, lons[slices], np.nan)
+    lats = np.where(mask, lats[slices], np.nan)
+    return (lons, lats) + tuple(data[slices] for data in datas)
+
 
 class Verification:
-    def __init__(self, lons1_kdtree, lats1_kdtree, lons2_query, lats2_query):
+    # direction='auto' 时，kdtree 数据量是 query 数据量的 INVERT_RATIO 倍以上，就反过来对 query 数据建模
+    INVERT_RATIO = 100
+
+    def __init__(self, lons1_kdtree, lats1_kdtree, lons2_query, lats2_query, kdtree_cache=None, direction='auto',
+                 spherical=False, workers=-1):
+        """
+        :param workers: KDtree 查询使用的线程数，-1 为全部 CPU
+        :param spherical: True 时在单位球的三维坐标上建模，pre_dist 和 dist 的单位为 km，
+            不同纬度的距离一致，跨 180 度经线和极区的数据也能正确匹配；False 时直接使用经纬度(度)
+        :param direction: KDtree 建模方向
+            'kdtree': 对 lons1/lats1 建模，用 lons2/lats2 查询
+            'query': 对 lons2/lats2 建模（例如几百个站点），用半径查询筛选 lons1/lats1，
+                     需要在 get_dist_and_index_kdtree 中给出 pre_dist
+            'auto': 根据两边的数据量自动选择
+        lons2_query/lats2_query 为 None 时只建模，使用 iter_matches 分块查询
+        """
         self.lons1_kdtree = lons1_kdtree  # KDtree建模用(分辨率高，数据量大)
         self.lats1_kdtree = lats1_kdtree  # KDtree建模用(分辨率高，数据量大)
 
         self.lons2_query = lons2_query  # 获取index用
         self.lats2_query = lats2_query  # 获取index用
 
-        self.valid_index1 = np.where(np.logical_and(np.isfinite(lons1_kdtree), np.isfinite(lats1_kdtree)))  # 有效建模数据的index
-        self.valid_index2 = np.where(np.logical_and(np.isfinite(lons2_query), np.isfinite(lats2_query)))  # 有效应用数据的index
-
+        valid1 = np.logical_and(np.isfinite(lons1_kdtree), np.isfinite(lats1_kdtree))
+        self.valid_index1 = np.where(valid1)  # 有效建模数据的index
         print(f'KDtree 数据的有效数量： {len(self.valid_index1[0])}')
-        print(f'Query 数据的有效数量： {len(self.valid_index2[0])}')
 
         if len(self.valid_index1) >= 1:
             self.lons1_kdtree = lons1_kdtree[self.valid_index1]
@@ -26,47 +193,203 @@ class Verification:
         else:
             raise ValueError('lons1 lats1没有足够的有效数据')
 
-        if len(self.valid_index2) >= 1:
-            self.lons2_query = lons2_query[self.valid_index2]
-            self.lats2_query = lats2_query[self.valid_index2]
+        if lons2_query is None:
+            self.valid_index2 = None
+            direction = 'kdtree'
         else:
-            raise ValueError('lons2 lat2没有足够的数据')
+            self.valid_index2 = np.where(np.logical_and(np.isfinite(lons2_query), np.isfinite(lats2_query)))  # 有效应用数据的index
+            print(f'Query 数据的有效数量： {len(self.valid_index2[0])}')
+            if len(self.valid_index2) >= 1:
+                self.lons2_query = lons2_query[self.valid_index2]
+                self.lats2_query = lats2_query[self.valid_index2]
+            else:
+                raise ValueError('lons2 lat2没有足够的数据')
+
+        self.spherical = spherical
+        self.workers = workers
+        self.timing = dict()  # 各阶段耗时
+
+        if direction == 'auto':
+            if len(self.valid_index2[0]) * self.INVERT_RATIO <= len(self.valid_index1[0]):
+                direction = 'query'
+            else:
+                direction = 'kdtree'
+        if direction not in ('kdtree', 'query'):
+            raise ValueError(f'direction 错误：{direction}')
+        self.direction = direction
+        print(f'KDtree 建模方向：{self.direction}')
+
+        # 只有对 lons1/lats1 建模时才使用缓存，query 方向不计算缓存键（需要对整个 swath 做哈希）
+        self.kdtree_cache = kdtree_cache  # lib.kdtree_cache.KdtreeCache
+        self.kdtree_key = None
+        if self.kdtree_cache is not None and self.direction == 'kdtree':
+            self.kdtree_key = make_cache_key(lons1_kdtree, lats1_kdtree, valid1,
+                                             tag='xyz' if self.spherical else 'lonlat')
 
         self.kdtree_model = None
+        self.query_kdtree_model = None  # direction='query' 时对 query 数据建模
         self.dist = None
         self.index_kdtree = None
 
-    @classmethod
-    def __format_data(cls, data):
-        data = data.reshape(-1, 1)
-        return data
-
     def __get_x(self, d1, d2):
-        return np.concatenate((self.__format_data(d1), self.__format_data(d2)), axis=1)
+        """
+        一次写入预先分配的 (N, 2) 或 (N, 3) float64 数组，cKDTree 直接使用，不再复制
+        """
+        if self.spherical:
+            return lon_lat_to_xyz(d1, d2)
+        x = np.empty((d1.size, 2), dtype=np.float64)
+        x[:, 0] = d1.reshape(-1)
+        x[:, 1] = d2.reshape(-1)
+        return x
+
+    def __get_query_dist(self, pre_dist):
+        """
+        距离阈值转换为 KDtree 中的距离
+        """
+        if pre_dist is None or not self.spherical:
+            return pre_dist
+        return km_to_chord(pre_dist)
+
+    def __timing(self, phase, t):
+        cost = time.perf_counter() - t
+        self.timing[phase] = self.timing.get(phase, 0.) + cost
+        print(f'{phase} 耗时：{cost:.3f}s')
+
+    def __query(self, kdtree_model, x, pre_dist=None):
+        """
+        多线程查询，给出 pre_dist 时超过阈值的点提前结束搜索，
+        这些点的 dist 为 inf，index 置为 0（不会越界，使用时需要用 dist 过滤）
+        """
+        if pre_dist is None:
+            return kdtree_model.query(x, workers=self.workers)
+        dist, index = kdtree_model.query(x, distance_upper_bound=pre_dist, workers=self.workers)
+        index[~np.isfinite(dist)] = 0
+        return dist, index
 
     def get_kdtree(self):
-        x = self.__get_x(self.lons1_kdtree, self.lats1_kdtree)
+        if self.direction == 'query':
+            try:
+                print('开始KDtree建模(query 数据)')
+                t = time.perf_counter()
+                self.query_kdtree_model = cKDTree(self.__get_x(self.lons2_query, self.lats2_query))
+                self.__timing('KDtree建模', t)
+                return True
+            except Exception as why:
+                print(why)
+                return False
+        return self.__get_kdtree()
+
+    def __get_kdtree(self):
         try:
             print('开始KDtree建模')
-            self.kdtree_model = cKDTree(x)
+            t = time.perf_counter()
+            if self.kdtree_key is not None:
+                self.kdtree_model, self.valid_index1 = self.kdtree_cache.get_or_build(
+                    self.kdtree_key, lambda: self.__get_x(self.lons1_kdtree, self.lats1_kdtree), self.valid_index1)
+            else:
+                self.kdtree_model = cKDTree(self.__get_x(self.lons1_kdtree, self.lats1_kdtree))
+            self.__timing('KDtree建模', t)
             return True
         except Exception as why:
             print(why)
             return False
 
-    def get_dist_and_index_kdtree(self):
+    def get_dist_and_index_kdtree(self, pre_dist=None):
         """
         获取距离和kdtree数据的index信息
+        :param pre_dist: 距离阈值，direction='query' 时必须给出；direction='kdtree' 时用于提前结束搜索，
+            超过阈值的点 dist 为 inf
         :return:
         """
-        self.dist, self.index_kdtree = self.kdtree_model.query(self.__get_x(self.lons2_query, self.lats2_query))
+        if self.direction == 'query' and pre_dist is None:
+            print('没有距离阈值，改为对 kdtree 数据建模')
+            self.direction = 'kdtree'
+            if not self.__get_kdtree():
+                raise ValueError('KDtree建模失败')
+        t = time.perf_counter()
+        if self.direction == 'query':
+            self.__get_dist_and_index_inverted(self.__get_query_dist(pre_dist))
+        else:
+            x2 = self.__get_x(self.lons2_query, self.lats2_query)
+            self.dist, self.index_kdtree = self.__query(self.kdtree_model, x2, self.__get_query_dist(pre_dist))
+        if self.spherical:
+            self.dist = chord_to_km(self.dist)
+        self.__timing('KDtree查询', t)
+
+    def __get_dist_and_index_inverted(self, pre_dist):
+        """
+        query 数据建模：先用 query 数据的 KDtree 筛选出距离任意 query 点 pre_dist 以内的 kdtree 数据，
+        再只对这部分数据建模，查询每个 query 点最近的 kdtree 数据。
+        距离 pre_dist 以内的最近点一定在筛选结果中，所以结果和正向建模一致；
+        距离超过 pre_dist 的 query 点，dist 为 inf
+        """
+        x1 = self.__get_x(self.lons1_kdtree, self.lats1_kdtree)
+        x2 = self.__get_x(self.lons2_query, self.lats2_query)
+        dist1, _ = self.__query(self.query_kdtree_model, x1, pre_dist)
+        candidate = np.flatnonzero(np.isfinite(dist1))
+        print(f'距离阈值内的 kdtree 数据量：{len(candidate)}')
+
+        self.dist = np.full(len(x2), np.inf)
+        self.index_kdtree = np.zeros(len(x2), dtype=np.intp)
+        if len(candidate) == 0:
+            return
+        dist, index = self.__query(cKDTree(x1[candidate]), x2, pre_dist)
+        found = np.isfinite(dist)
+        self.dist[found] = dist[found]
+        self.index_kdtree[found] = candidate[index[found]]
+
+    def iter_matches(self, lons2, lats2, pre_dist, block_rows=256):
+        """
+        分块流式匹配：query 数据按第一维每 block_rows 行一块，单独查询并按 pre_dist 过滤，只返回匹配到的数据，
+        峰值内存由块大小决定，和整个轨道的数据量无关
+        :param lons2: query 经度，1 维或者 2 维
+        :param lats2: query 纬度
+        :param pre_dist: 距离阈值，spherical=True 时单位为 km
+        :param block_rows: 每块的行数
+        :return: 生成器，每块返回 dict
+            index_query: lons2 中匹配到的数据的 index（与 np.where 的结果格式相同）
+            index_kdtree: 对应的 kdtree 有效数据的 index，用 get_kdtree_data_by_index 取数据
+            dist: 距离
+        """
+        if self.kdtree_model is None and not self.__get_kdtree():
+            raise ValueError('KDtree建模失败')
+        query_dist = self.__get_query_dist(pre_dist)
+        for start in range(0, lons2.shape[0], block_rows):
+            t = time.perf_counter()
+            lons_block = lons2[start:start + block_rows]
+            lats_block = lats2[start:start + block_rows]
+            index_block = np.nonzero(np.logical_and(np.isfinite(lons_block), np.isfinite(lats_block)))
+            if len(index_block[0]) == 0:
+                continue
+            x = self.__get_x(lons_block[index_block], lats_block[index_block])
+            dist, index = self.__query(self.kdtree_model, x, query_dist)
+            if self.spherical:
+                dist = chord_to_km(dist)
+            matched = dist < pre_dist
+            self.__timing('KDtree分块查询', t)
+            if not matched.any():
+                continue
+            yield {
+                'index_query': (index_block[0][matched] + start,) + tuple(i[matched] for i in index_block[1:]),
+                'index_kdtree': index[matched],
+                'dist': dist[matched],
+            }
+
+    def get_kdtree_data_by_index(self, data, index_kdtree):
+        """
+        用 iter_matches 返回的 index_kdtree 获取 kdtree 建模数据，只取需要的点，不复制整个数组
+        """
+        return data[tuple(i[index_kdtree] for i in self.valid_index1)]
 
     def get_index_dist(self, pre_dist=0.01):
         """
         获取符合距离阈值的index信息
+        :param pre_dist: 距离阈值，spherical=True 时单位为 km
         :return:
         """
-        print(f'dist ：：min {np.min(self.dist)}  max {np.max(self.dist)} mean {np.mean(self.dist)}')
+        dist = self.dist[np.isfinite(self.dist)]
+        if len(dist) > 0:
+            print(f'dist ：：min {np.min(dist)}  max {np.max(dist)} mean {np.mean(dist)}')
         index_dist = self.dist < pre_dist
         result_count = index_dist.sum()
         print(f'符合距离阈值的数据量=========：{result_count}')
@@ -87,3 +410,35 @@ class Verification:
         :return:
         """
         return data[self.valid_index2]
+
+    def get_kdtree_window_data(self, data, window=3):
+        """
+        获取每个 query 数据在 kdtree 建模数据上最近点周围 window x window 窗口的统计值
+        一次花式索引取出全部窗口，没有逐站点循环
+        :param data: 与 kdtree 建模使用的经纬度 shape 相同的 2 维数据，无效值为 nan
+        :param window: 窗口大小，奇数
+        :return: dict(mean, median, std, count)
+        """
+        if data.ndim != 2 or len(self.valid_index1) != 2:
+            raise ValueError('窗口统计需要 2 维的 kdtree 建模数据')
+        half = window // 2
+        offsets = np.arange(-half, half + 1)
+        row_count, col_count = data.shape
+
+        rows = self.valid_index1[0][self.index_kdtree][:, None, None] + offsets[None, :, None]
+        cols = self.valid_index1[1][self.index_kdtree][:, None, None] + offsets[None, None, :]
+        inside = (rows >= 0) & (rows < row_count) & (cols >= 0) & (cols < col_count)
+        values = data[np.clip(rows, 0, row_count - 1), np.clip(cols, 0, col_count - 1)].astype(np.float64)
+        values[~inside] = np.nan
+        values = values.reshape(len(values), -1)
+
+        count = np.isfinite(values).sum(axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # 窗口内没有有效数据时结果为 nan
+            result = {
+                'mean': np.nanmean(values, axis=1),
+                'median': np.nanmedian(values, axis=1),
+                'std': np.nanstd(values, axis=1),
+                'count': count,
+            }
+        return result